@@ -0,0 +1,156 @@
+"""Denormalized counters kept up to date by triggers.
+
+``tag_counts`` holds the number of messages per tag,
+``messages.reaction_counts`` holds each message's reactions as a JSON object
+and ``messages.comment_count`` its number of comments, so the feed and the
+popular-tags list read them directly instead of re-aggregating on every page
+view.
+"""
+
+REACTION_COUNTS_SQL = '''
+    COALESCE((SELECT json_group_object(reaction, count)
+              FROM reactions WHERE message_id = {message_id}), '{{}}')
+'''
+
+COMMENT_COUNTS_SQL = '''
+    UPDATE messages
+    SET comment_count = (SELECT COUNT(*) FROM comments WHERE comments.message_id = messages.id)
+'''
+
+
+def create_aggregates(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_counts
+        (tag_id INTEGER PRIMARY KEY,
+         count INTEGER NOT NULL DEFAULT 0,
+         FOREIGN KEY (tag_id) REFERENCES tags (id))
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tag_counts_count
+        ON tag_counts (count)
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_tags_count_insert
+        AFTER INSERT ON message_tags
+        BEGIN
+            INSERT INTO tag_counts (tag_id, count) VALUES (NEW.tag_id, 1)
+            ON CONFLICT(tag_id) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_tags_count_delete
+        AFTER DELETE ON message_tags
+        BEGIN
+            UPDATE tag_counts SET count = count - 1 WHERE tag_id = OLD.tag_id;
+        END
+    ''')
+
+    cursor.execute("PRAGMA table_info(messages)")
+    if 'reaction_counts' not in {column[1] for column in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE messages ADD COLUMN reaction_counts TEXT NOT NULL DEFAULT '{}'")
+    for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS reactions_counts_{event.lower()}
+            AFTER {event} ON reactions
+            BEGIN
+                UPDATE messages
+                SET reaction_counts = {REACTION_COUNTS_SQL.format(message_id=f'{row}.message_id')}
+                WHERE id = {row}.message_id;
+            END
+        ''')
+
+    _rebuild_tag_and_reaction_counts(cursor)
+
+
+def create_comment_counts(cursor):
+    cursor.execute("PRAGMA table_info(messages)")
+    if 'comment_count' not in {column[1] for column in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE messages ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS comments_count_insert
+        AFTER INSERT ON comments
+        BEGIN
+            UPDATE messages SET comment_count = comment_count + 1 WHERE id = NEW.message_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS comments_count_delete
+        AFTER DELETE ON comments
+        BEGIN
+            UPDATE messages SET comment_count = comment_count - 1 WHERE id = OLD.message_id;
+        END
+    ''')
+    cursor.execute(COMMENT_COUNTS_SQL)
+
+
+def rebuild_aggregates(cursor):
+    """Recompute every counter from the base tables."""
+    _rebuild_tag_and_reaction_counts(cursor)
+    cursor.execute(COMMENT_COUNTS_SQL)
+
+
+# Separate from rebuild_aggregates so create_aggregates still runs on a
+# schema that doesn't have comment_count yet
+def _rebuild_tag_and_reaction_counts(cursor):
+    cursor.execute("DELETE FROM tag_counts")
+    cursor.execute('''
+        INSERT INTO tag_counts (tag_id, count)
+        SELECT tag_id, COUNT(*) FROM message_tags GROUP BY tag_id
+    ''')
+    cursor.execute(f'''
+        UPDATE messages
+        SET reaction_counts = {REACTION_COUNTS_SQL.format(message_id='messages.id')}
+    ''')
+
+
+def check_aggregates(cursor):
+    """Return a list of human-readable mismatches; empty means consistent."""
+    problems = []
+    cursor.execute('''
+        SELECT tags.name, COALESCE(tag_counts.count, 0), COALESCE(actual.count, 0)
+        FROM tags
+        LEFT JOIN tag_counts ON tag_counts.tag_id = tags.id
+        LEFT JOIN (SELECT tag_id, COUNT(*) AS count FROM message_tags GROUP BY tag_id) AS actual
+            ON actual.tag_id = tags.id
+        WHERE COALESCE(tag_counts.count, 0) != COALESCE(actual.count, 0)
+    ''')
+    for name, stored, actual in cursor.fetchall():
+        problems.append(f"tag {name!r}: stored count {stored}, actual {actual}")
+
+    cursor.execute('''
+        SELECT messages.id, messages.reaction_counts
+        FROM messages
+        WHERE (SELECT COUNT(*) FROM json_each(messages.reaction_counts))
+              != (SELECT COUNT(*) FROM reactions WHERE reactions.message_id = messages.id)
+           OR EXISTS (
+              SELECT 1 FROM reactions
+              WHERE reactions.message_id = messages.id
+                AND NOT EXISTS (SELECT 1 FROM json_each(messages.reaction_counts) AS stored
+                                WHERE stored.key = reactions.reaction
+                                  AND stored.value = reactions.count))
+    ''')
+    for message_id, stored in cursor.fetchall():
+        problems.append(f"message {message_id}: stored reactions {stored} do not match reactions table")
+
+    cursor.execute('''
+        SELECT messages.id, messages.comment_count, COALESCE(actual.count, 0)
+        FROM messages
+        LEFT JOIN (SELECT message_id, COUNT(*) AS count FROM comments GROUP BY message_id) AS actual
+            ON actual.message_id = messages.id
+        WHERE messages.comment_count != COALESCE(actual.count, 0)
+    ''')
+    for message_id, stored, actual in cursor.fetchall():
+        problems.append(f"message {message_id}: stored comment count {stored}, actual {actual}")
+    return problems
+
+
+def popular_tags(cursor, limit=10):
+    cursor.execute('''
+        SELECT tags.name, tag_counts.count
+        FROM tag_counts
+        JOIN tags ON tags.id = tag_counts.tag_id
+        WHERE tag_counts.count > 0
+        ORDER BY tag_counts.count DESC
+        LIMIT ?
+    ''', (limit,))
+    return cursor.fetchall()
@@ -1,568 +1,660 @@
 import os
-from flask import Flask, request, render_template_string, redirect, url_for, g, jsonify
+import atexit
+import functools
+import hashlib
+import time
+import click
+from flask import Flask, request, redirect, url_for, g, jsonify, abort, send_file, make_response, get_template_attribute, stream_with_context
 from dotenv import load_dotenv
-import sqlite3
-from flask_socketio import SocketIO, emit
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from datetime import datetime
-import requests
 import base64
 import io
 from PIL import Image
+from db import ConnectionPool, migrate
+from aggregates import check_aggregates, rebuild_aggregates, popular_tags as load_popular_tags
+from feed import (fetch_comment_page, fetch_feed_page, fetch_messages, message_to_dict, image_url,
+                  comment_cursor, comment_to_dict)
+from search import search
+from posts import TagResolver, create_comment, create_message, import_jsonl
+from export import export_ndjson, export_to_directory, read_export, restore_images
+from cache import LRUCache, RenderCache
+from compression import init_compression
+from versions import feed_version
+from changes import RELOAD, ChangeLogCompactor, changes_since, latest_seq, record_change
+from providers import provider_from_env
+from reactions import ReactionAccumulator
+from jobs import ImageJobQueue, GenerationCache, QueueFull, DONE
+from pubsub import CACHE_EVENT, queue_manager
+from ratelimit import RateLimiter, backend_from_url, parse_rules, retry_after_header
+from metrics import (InstrumentedConnection, SamplingProfiler, emit_duration, init_metrics,
+                     provider_collector, registry, socket_clients, rate_limited,
+                     image_jobs_rejected)
+from images import (EncoderPool, ImageTooLarge, InvalidImage, IMAGE_MIMETYPE, VARIANTS,
+                    migrate_inline_images, store_from_env)
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key_here'
-socketio = SocketIO(app)
+app.add_template_filter(comment_cursor)
+
+# With several worker processes, events and cache invalidations go through
+# a message queue (redis://..., sqlite:///queue.db, ...); see serve.py
+MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+ASYNC_MODE = os.getenv('SOCKETIO_ASYNC_MODE') or None
+
+def apply_cache_invalidation(payload):
+    if payload.get('clear'):
+        render_cache.clear()
+        return
+    if payload.get('messages'):
+        render_cache.invalidate_messages(payload['messages'])
+    if payload.get('feeds'):
+        render_cache.invalidate_feeds(payload['feeds'])
+
+if MESSAGE_QUEUE:
+    socketio = SocketIO(app, async_mode=ASYNC_MODE,
+                        client_manager=queue_manager(MESSAGE_QUEUE, apply_cache_invalidation))
+else:
+    socketio = SocketIO(app, async_mode=ASYNC_MODE)
+
+def emit_event(event, data, **kwargs):
+    with emit_duration.time(event):
+        socketio.emit(event, data, **kwargs)
+
+def invalidate_cache(messages=(), feeds=(), clear=False):
+    """Drop stale rendered HTML in this worker and, via the queue, all others."""
+    payload = {'messages': list(messages), 'feeds': list(feeds), 'clear': clear}
+    if MESSAGE_QUEUE:
+        emit_event(CACHE_EVENT, payload)
+    else:
+        apply_cache_invalidation(payload)
+
+DATABASE = os.getenv('MESSAGE_BOARD_DB', 'message_board.db')
+# Uploads are decoded, scaled to IMAGE_MAX_DIMENSION and re-encoded within
+# IMAGE_MAX_KB in IMAGE_PROCESSES worker processes (0 encodes in-process)
+IMAGE_PROCESSES = int(os.getenv('IMAGE_PROCESSES', min(2, os.cpu_count() or 1)))
+image_encoder = EncoderPool(IMAGE_PROCESSES) if IMAGE_PROCESSES > 0 else None
+if image_encoder is not None:
+    atexit.register(image_encoder.shutdown)
+image_store = store_from_env(encoder=image_encoder)
+# A base64 image_data field is a third bigger than the image itself
+app.config['MAX_FORM_MEMORY_SIZE'] = max(app.config['MAX_FORM_MEMORY_SIZE'],
+                                         image_store.max_upload_bytes * 4 // 3 + 64 * 1024)
+
+db_pool = ConnectionPool(DATABASE, factory=InstrumentedConnection)
 
 # Database setup
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect('message_board.db')
+        db = g._database = db_pool.acquire()
     return db
 
+with db_pool.connection() as db:
+    migrate(db)
+    migrate_inline_images(db, image_store)
+
+GENERATION_PARAMS = {
+    "engine": "stable-diffusion-xl-1024-v1-0",
+    "cfg_scale": 7,
+    "height": 1024,
+    "width": 1024,
+    "samples": 1,
+    "steps": 30,
+}
+
+image_provider = provider_from_env()
+
+init_metrics(app, slow_ms=float(os.getenv('SLOW_QUERY_MS')) if os.getenv('SLOW_QUERY_MS') else None)
+registry.add_collector(provider_collector('image_provider', image_provider.metrics))
+
+# Off unless PROFILE_SAMPLE_MS is set; stacks are read from /debug/profile
+profiler = None
+if os.getenv('PROFILE_SAMPLE_MS'):
+    profiler = SamplingProfiler(float(os.getenv('PROFILE_SAMPLE_MS')) / 1000).start()
+
 # Add this function to handle image generation
-def generate_image_with_stability(prompt):
-    api_key = os.getenv("STABILITY_API_KEY")
-    if not api_key:
-        return None, "Stability API key not set"
-
-    url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
-    headers = {
-        "Accept": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    payload = {
-        "text_prompts": [{"text": prompt}],
-        "cfg_scale": 7,
-        "height": 1024,
-        "width": 1024,
-        "samples": 1,
-        "steps": 30,
+def generate_image_with_stability(prompt, params=GENERATION_PARAMS):
+    return image_provider.generate(prompt, params)
+
+def image_job_to_dict(job):
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "cached": job.cached,
+        "error": job.error,
+        "image_hash": job.image_hash,
+        "image_url": image_url(job.image_hash),
+        "thumbnail_url": image_url(job.image_hash, 'thumb'),
     }
 
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        data = response.json()
-        image_data = data["artifacts"][0]["base64"]
-        return image_data, None
-    except requests.exceptions.RequestException as e:
-        return None, str(e)
+def notify_image_job(job):
+    # Runs on a worker thread, outside any request
+    with app.test_request_context():
+        payload = image_job_to_dict(job)
+    for sid in list(job.sids):
+        emit_event('image_job', payload, to=sid)
+
+# Socket.IO rooms: a page joins its feed room plus one room per message it shows
+MAX_SUBSCRIBED_MESSAGES = 1000
+
+def feed_room(tag_name=None):
+    return f'tag:{tag_name}' if tag_name else 'feed'
+
+def message_room(message_id):
+    return f'message:{message_id}'
+
+tag_resolver = TagResolver()
+render_cache = RenderCache(int(os.getenv('RENDER_CACHE_MB', 32)) * 1024 * 1024)
+compressed_cache = LRUCache(int(os.getenv('COMPRESSED_CACHE_MB', 16)) * 1024 * 1024)
+init_compression(app, compressed_cache)
+
+def broadcast_reactions(updated):
+    invalidate_cache(messages=updated)
+    # One merged update per message per flush
+    for message_id, change in updated.items():
+        emit_event('reaction_update', change, to=message_room(message_id))
+
+reaction_accumulator = ReactionAccumulator(
+    db_pool, on_flush=broadcast_reactions,
+    interval=int(os.getenv('REACTION_FLUSH_MS', 250)) / 1000).start()
+atexit.register(reaction_accumulator.stop)
+
+# Reconnecting clients can replay this far back; older gaps mean a reload
+change_log_compactor = ChangeLogCompactor(
+    db_pool, max_age=float(os.getenv('CHANGE_LOG_RETENTION_HOURS', 24)) * 3600).start()
+atexit.register(change_log_compactor.stop)
+
+image_jobs = ImageJobQueue(generate_image_with_stability, image_store,
+                           GenerationCache(db_pool, int(os.getenv('IMAGE_CACHE_SIZE', 500))),
+                           max_workers=int(os.getenv('IMAGE_WORKERS', 2)),
+                           on_complete=notify_image_job,
+                           max_pending=int(os.getenv('IMAGE_QUEUE_SIZE', 20)))
+
+# Per client and endpoint: 'endpoint=count/second|minute|hour:burst'
+DEFAULT_RATE_LIMITS = ('post_message=12/minute:5,post_comment=30/minute:10,'
+                       'add_reaction=5/second:20,generate_image=6/minute:3,'
+                       'import_messages=4/hour:2')
+rate_limiter = RateLimiter(backend_from_url(os.getenv('RATE_LIMIT_BACKEND')),
+                           parse_rules(os.getenv('RATE_LIMITS', DEFAULT_RATE_LIMITS)))
+
+# Behind serve.py's proxy every request comes from the proxy's address;
+# trust that many X-Forwarded-For hops to find the real client
+if os.getenv('TRUSTED_PROXIES'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('TRUSTED_PROXIES')))
+
+def retry_later(message, status, retry_after):
+    seconds = retry_after_header(retry_after)
+    response = jsonify({"error": message, "retry_after": int(seconds)})
+    response.status_code = status
+    response.headers['Retry-After'] = seconds
+    return response
+
+@app.before_request
+def enforce_rate_limits():
+    retry_after = rate_limiter.check(request.endpoint, request.remote_addr)
+    if retry_after is not None:
+        rate_limited.inc(request.endpoint)
+        return retry_later("Too many requests", 429, retry_after)
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        db_pool.release(db)
 
-def init_db():
-    with app.app_context():
-        db = get_db()
-        cursor = db.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-             content TEXT NOT NULL,
-             image_data TEXT,
-             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS comments
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-             message_id INTEGER,
-             content TEXT NOT NULL,
-             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-             FOREIGN KEY (message_id) REFERENCES messages (id))
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tags
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-             name TEXT UNIQUE NOT NULL)
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS message_tags
-            (message_id INTEGER,
-             tag_id INTEGER,
-             FOREIGN KEY (message_id) REFERENCES messages (id),
-             FOREIGN KEY (tag_id) REFERENCES tags (id),
-             PRIMARY KEY (message_id, tag_id))
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS reactions
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-             message_id INTEGER,
-             reaction TEXT,
-             count INTEGER DEFAULT 0,
-             FOREIGN KEY (message_id) REFERENCES messages (id),
-             UNIQUE(message_id, reaction))
-        ''')
-        
-        db.commit()
+def get_feed_page(tag_name=None):
+    try:
+        return fetch_feed_page(get_db().cursor(), tag_name=tag_name,
+                               after=request.args.get('cursor'))
+    except ValueError:
+        abort(400)
 
-init_db()
+TEMPLATES = ('board.html', 'macros.html')
+# Chunks of template output grouped per write; small enough that the page
+# head goes out before the first message has been rendered
+STREAM_BUFFER = 8
 
-@app.route('/')
-def index():
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute('''
-        SELECT messages.id, messages.content, messages.image_data, messages.timestamp
-        FROM messages
-        ORDER BY messages.timestamp DESC
-    ''')
-    messages = cursor.fetchall()
+def render_message(message, snippets=None):
+    message_card = get_template_attribute('macros.html', 'message_card')
+    if snippets:
+        # Search hits are specific to the query, so they are never cached
+        return message_card(message, snippets)
+    # Keyed by what the card shows, so an invalidation still in the queue
+    # from another worker can't leave an outdated card in use
+    key = (message.id, message.comment_count, tuple(sorted(message.reactions.items())))
+    html = render_cache.get_fragment(key)
+    if html is None:
+        version = render_cache.version
+        html = str(message_card(message))
+        render_cache.set_fragment(key, html, version=version)
+    return Markup(html)
+
+def stream_page(on_complete=None, **context):
+    """Stream board.html chunk by chunk; on_complete gets the whole page once sent."""
+    template = app.jinja_env.get_template('board.html')
+    app.update_template_context(context)
+    stream = template.stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
     
-    for i, message in enumerate(messages):
-        cursor.execute('''
-            SELECT comments.content, comments.timestamp
-            FROM comments
-            WHERE comments.message_id = ?
-            ORDER BY comments.timestamp ASC
-        ''', (message[0],))
-        comments = cursor.fetchall()
-        
-        cursor.execute('''
-            SELECT tags.name
-            FROM tags
-            JOIN message_tags ON tags.id = message_tags.tag_id
-            WHERE message_tags.message_id = ?
-        ''', (message[0],))
-        tags = [tag[0] for tag in cursor.fetchall()]
-        
-        cursor.execute('''
-            SELECT reaction, count
-            FROM reactions
-            WHERE message_id = ?
-        ''', (message[0],))
-        reactions = dict(cursor.fetchall())
-        
-        messages[i] = message + (comments, tags, reactions)
+    def generate():
+        chunks = []
+        for chunk in stream:
+            if on_complete is not None:
+                chunks.append(chunk)
+            yield chunk
+        if on_complete is not None:
+            on_complete(''.join(chunks))
     
-    cursor.execute('''
-        SELECT tags.name, COUNT(*) as tag_count
-        FROM tags
-        JOIN message_tags ON tags.id = message_tags.tag_id
-        GROUP BY tags.id
-        ORDER BY tag_count DESC
-        LIMIT 10
-    ''')
-    popular_tags = cursor.fetchall()
+    return stream_with_context(generate())
+
+@functools.lru_cache(maxsize=None)
+def template_version():
+    # Part of every ETag, so a deploy with new markup never gets a stale 304
+    sources = (app.jinja_loader.get_source(app.jinja_env, name)[0] for name in TEMPLATES)
+    return hashlib.sha1(''.join(sources).encode()).hexdigest()[:12]
+
+def conditional_feed_response(tag_name, render):
+    """Answer with 304 when the client has this feed version, else render(version)."""
+    version, last_modified = feed_version(get_db().cursor(), feed_room(tag_name))
+    etag = hashlib.sha1(f'{template_version()}:{request.full_path}:{version}'.encode()).hexdigest()
     
-    return render_template_string(BASE_HTML, messages=messages, popular_tags=popular_tags)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render(version))
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    # Always revalidate; unchanged feeds cost a 304
+    response.cache_control.no_cache = True
+    return response
+
+def render_feed_page(tag_name, version):
+    room = feed_room(tag_name)
+    after = request.args.get('cursor')
+    # The feed version is part of the key, so a page rendered before a write
+    # is never served after it, even if its invalidation hasn't run yet
+    key = (room, after, version)
+    html = render_cache.get_page(key)
+    if html is not None:
+        return html
+    
+    cache_version = render_cache.version
+    # Read before the page so replaying from it can only repeat, never skip
+    change_seq = latest_seq(get_db().cursor())
+    messages, next_cursor = get_feed_page(tag_name)
+    context = {}
+    if tag_name is None:
+        if after is None:
+            context['popular_tags'] = load_popular_tags(get_db().cursor())
+        load_more_url = url_for('index', cursor=next_cursor) if next_cursor else None
+    else:
+        context['current_tag'] = tag_name
+        load_more_url = url_for('view_tag', tag_name=tag_name, cursor=next_cursor) if next_cursor else None
+    
+    message_ids = [message.id for message in messages]
+    
+    def cache_page(html):
+        render_cache.set_page(key, html, message_ids,
+                              feed=room if after is None else None, version=cache_version)
+    
+    return stream_page(cache_page, fragments=(render_message(message) for message in messages),
+                       feed_room=room, feed_version=version, load_more_url=load_more_url,
+                       change_seq=change_seq,
+                       **context)
+
+def feed_json(tag_name):
+    messages, next_cursor = get_feed_page(tag_name)
+    return jsonify({"messages": [message_to_dict(m) for m in messages],
+                    "next_cursor": next_cursor})
+
+@app.route('/')
+def index():
+    return conditional_feed_response(None, lambda version: render_feed_page(None, version))
+
+@app.route('/api/feed')
+def api_feed():
+    return conditional_feed_response(None, lambda version: feed_json(None))
 
 @app.route('/post_message', methods=['POST'])
 def post_message():
     content = request.form.get('content')
-    tags = request.form.get('tags', '').split(',')
+    tags = request.form.get('tags', '')
     image_data = request.form.get('image_data')
+    image_hash = request.form.get('image_hash') or None
     
-    if content or image_data:
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute("INSERT INTO messages (content, image_data) VALUES (?, ?)",
-                       (content, image_data))
-        message_id = cursor.lastrowid
-        
-        for tag in tags:
-            tag = tag.strip().lower()
-            if tag:
-                cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
-                cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
-                tag_id = cursor.fetchone()[0]
-                cursor.execute("INSERT INTO message_tags (message_id, tag_id) VALUES (?, ?)",
-                               (message_id, tag_id))
+    if image_hash and not image_store.exists(image_hash):
+        return "Unknown image", 400
+    
+    if content or image_data or image_hash:
+        if image_data and not image_hash:
+            try:
+                image_hash = image_store.put_base64(image_data)
+            except ImageTooLarge as e:
+                return str(e), 413
+            except InvalidImage as e:
+                return str(e), 400
         
-        db.commit()
+        new_message, tag_names, change = create_message(get_db(), tag_resolver, content or '',
+                                                        image_hash, tags)
         
-        cursor.execute('''
-            SELECT messages.id, messages.content, messages.image_data, messages.timestamp
-            FROM messages
-            WHERE messages.id = ?
-        ''', (message_id,))
-        new_message = cursor.fetchone()
+        invalidate_cache(feeds=[feed_room()] + [feed_room(tag) for tag in tag_names])
         
-        socketio.emit('new_message', {
-            'id': new_message[0],
-            'content': new_message[1],
-            'image_data': new_message[2],
-            'timestamp': new_message[3],
-            'tags': tags,
-            'reactions': {}
-        })
+        # Only clients watching the main feed or one of the message's tags
+        emit_event('new_message', new_message_event(change),
+                   to=[feed_room()] + [feed_room(tag) for tag in tag_names])
     return redirect(url_for('index'))
 
+def new_message_event(change):
+    """Client payload for a logged new_message change."""
+    return {
+        'id': change['id'],
+        'content': change['content'],
+        'image_url': image_url(change['image_hash']),
+        'thumbnail_url': image_url(change['image_hash'], 'thumb'),
+        'timestamp': change['timestamp'],
+        'tags': change['tags'],
+        'reactions': {},
+        'seq': change['seq'],
+    }
+
+def import_board(lines, restore=False):
+    with db_pool.connection() as db:
+        counts = import_jsonl(db, tag_resolver, lines, preserve_ids=restore)
+        # Too many rows to replay; clients further back than this reload
+        with db:
+            record_change(db.cursor(), RELOAD, {})
+    # Imported rows can land on any page
+    invalidate_cache(clear=True)
+    return counts
+
+@app.route('/import', methods=['POST'])
+def import_messages():
+    restore = request.args.get('restore') == '1'
+    if restore:
+        cursor = get_db().cursor()
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM messages)")
+        if cursor.fetchone()[0]:
+            # Kept ids would be mixed with this board's own messages
+            return jsonify({"error": "Restore needs an empty board; "
+                                     "use flask restore to add an incremental export"}), 409
+    return jsonify(import_board(request.stream, restore=restore))
+
+def export_since(args):
+    try:
+        return {
+            'since_message_id': int(args.get('since_message_id') or 0),
+            'since_comment_id': int(args.get('since_comment_id') or 0),
+            'since_timestamp': args.get('since_timestamp') or None,
+        }
+    except (TypeError, ValueError):
+        abort(400)
+
+@app.route('/export')
+def export_board():
+    since = export_since(request.args)
+    
+    def generate():
+        # Holds its own connection for as long as the download runs
+        with db_pool.connection() as db:
+            yield from export_ndjson(db, **since)
+    
+    response = app.response_class(generate(), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = 'attachment; filename=board.ndjson'
+    return response
+
+def replay_changes(since, feeds=None, message_ids=None, version=None):
+    """Changes after ``since`` for a client showing ``feeds`` and ``message_ids``.
+
+    None means no filter. Messages the replay itself adds to a shown feed
+    get their later comments and reactions too. ``version`` is the feed
+    version the client's page was rendered at: while the feed is still at
+    it nothing the page shows has changed, so however old ``since`` is
+    (a cached page keeps the seq it was rendered with), the client is just
+    moved on to the latest seq.
+    """
+    cursor = get_db().cursor()
+    if version is not None and feeds is not None and len(feeds) == 1:
+        # The seq is read first; anything after it reaches the client live
+        latest = latest_seq(cursor)
+        if feed_version(cursor, feeds[0])[0] == version:
+            return {'changes': [], 'last_seq': latest, 'more': False, 'reload': False}
+    batch = changes_since(cursor, since)
+    message_ids = None if message_ids is None else set(message_ids)
+    relevant = []
+    for change in batch['changes']:
+        data = change['data']
+        if change['event'] == 'new_message':
+            if feeds is not None and 'feed' not in feeds and \
+                    not any(feed_room(tag) in feeds for tag in data['tags']):
+                continue
+            if message_ids is not None:
+                message_ids.add(data['id'])
+            change = dict(change, data=new_message_event(data))
+        elif message_ids is not None and data['message_id'] not in message_ids:
+            continue
+        relevant.append(change)
+    return dict(batch, changes=relevant)
+
+@app.route('/changes')
+def changes():
+    try:
+        since = int(request.args['since'])
+    except (KeyError, ValueError):
+        return jsonify({"error": "since must be a change seq"}), 400
+    feed = request.args.get('feed')
+    return jsonify(replay_changes(since, feeds=[feed] if feed else None))
+
 @app.route('/generate_image', methods=['POST'])
 def generate_image():
     prompt = request.form.get('prompt')
-    image_data, error = generate_image_with_stability(prompt)
+    if not prompt:
+        return jsonify({"error": "Prompt is required"}), 400
     
-    if error:
-        return jsonify({"error": error}), 500
-    
-    return jsonify({"image_data": image_data})
+    try:
+        job = image_jobs.submit(prompt, GENERATION_PARAMS, sid=request.form.get('sid'))
+    except QueueFull:
+        image_jobs_rejected.inc()
+        # Roughly how long the provider takes to work through one job
+        latency = image_provider.metrics.snapshot()['latency_p50'] or 5
+        return retry_later("Image generation is busy, try again shortly", 503, latency)
+    return jsonify(image_job_to_dict(job)), 200 if job.status == DONE else 202
+
+@app.route('/generate_image/<job_id>')
+def image_job_status(job_id):
+    job = image_jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(image_job_to_dict(job))
+
+@app.route('/api/image_provider/stats')
+def image_provider_stats():
+    return jsonify(image_provider.metrics.snapshot())
+
+@app.route('/debug/profile')
+def profile():
+    if profiler is None:
+        abort(404)
+    # Folded stacks, ready for flamegraph.pl or speedscope
+    return app.response_class(profiler.folded(reset=request.args.get('reset') == '1'),
+                              mimetype='text/plain')
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    return jsonify(dict(render_cache.stats(), compressed=compressed_cache.stats()))
+
+@app.route('/images/<digest>', defaults={'variant': 'full'})
+@app.route('/images/<digest>/<variant>')
+def image(digest, variant):
+    if variant not in VARIANTS or not image_store.exists(digest):
+        abort(404)
+    # Content-addressed, so a given URL never changes
+    response = send_file(image_store.path(digest, variant), mimetype=IMAGE_MIMETYPE,
+                         etag=f'{digest}-{variant}', conditional=True, max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/tag/<tag_name>')
 def view_tag(tag_name):
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute('''
-        SELECT messages.id, messages.content, messages.image_data, messages.timestamp
-        FROM messages
-        JOIN message_tags ON messages.id = message_tags.message_id
-        JOIN tags ON message_tags.tag_id = tags.id
-        WHERE tags.name = ?
-        ORDER BY messages.timestamp DESC
-    ''', (tag_name,))
-    messages = cursor.fetchall()
+    return conditional_feed_response(tag_name, lambda version: render_feed_page(tag_name, version))
+
+@app.route('/api/tag/<tag_name>')
+def api_tag(tag_name):
+    return conditional_feed_response(tag_name, lambda version: feed_json(tag_name))
+
+def get_search_page():
+    query = request.args.get('q', '').strip()
+    try:
+        offset = max(int(request.args.get('cursor', 0)), 0)
+    except ValueError:
+        abort(400)
+    hits, next_offset = search(get_db().cursor(), query, offset=offset)
+    return query, hits, next_offset
+
+@app.route('/search')
+def search_page():
+    change_seq = latest_seq(get_db().cursor())
+    query, hits, next_offset = get_search_page()
     
-    for i, message in enumerate(messages):
-        cursor.execute('''
-            SELECT comments.content, comments.timestamp
-            FROM comments
-            WHERE comments.message_id = ?
-            ORDER BY comments.timestamp ASC
-        ''', (message[0],))
-        comments = cursor.fetchall()
-        
-        cursor.execute('''
-            SELECT tags.name
-            FROM tags
-            JOIN message_tags ON tags.id = message_tags.tag_id
-            WHERE message_tags.message_id = ?
-        ''', (message[0],))
-        tags = [tag[0] for tag in cursor.fetchall()]
-        
-        cursor.execute('''
-            SELECT reaction, count
-            FROM reactions
-            WHERE message_id = ?
-        ''', (message[0],))
-        reactions = dict(cursor.fetchall())
-        
-        messages[i] = message + (comments, tags, reactions)
+    snippets = {}
+    for hit in hits:
+        snippets.setdefault(hit['message_id'], []).append(hit['snippet'])
+    messages = fetch_messages(get_db().cursor(), list(snippets))
     
-    return render_template_string(BASE_HTML, messages=messages, current_tag=tag_name)
+    load_more_url = url_for('search_page', q=query, cursor=next_offset) if next_offset else None
+    return app.response_class(stream_page(search_query=query, load_more_url=load_more_url,
+                                          change_seq=change_seq,
+                                          fragments=(render_message(m, snippets[m.id])
+                                                     for m in messages)))
+
+@app.route('/api/search')
+def api_search():
+    query, hits, next_offset = get_search_page()
+    return jsonify({"results": [dict(hit, snippet=str(hit['snippet'])) for hit in hits],
+                    "next_cursor": str(next_offset) if next_offset else None})
 
 @app.route('/post_comment/<int:message_id>', methods=['POST'])
 def post_comment(message_id):
     content = request.form.get('content')
     if content:
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute("INSERT INTO comments (message_id, content) VALUES (?, ?)",
-                       (message_id, content))
-        comment_id = cursor.lastrowid
-        db.commit()
-        
-        cursor.execute('''
-            SELECT comments.content, comments.timestamp
-            FROM comments
-            WHERE comments.id = ?
-        ''', (comment_id,))
-        new_comment = cursor.fetchone()
-        
-        socketio.emit('new_comment', {
-            'message_id': message_id,
-            'content': new_comment[0],
-            'timestamp': new_comment[1]
-        })
+        change = create_comment(get_db(), message_id, content)
+        invalidate_cache(messages=[message_id])
+        emit_event('new_comment', change, to=message_room(message_id))
     return redirect(url_for('index'))
 
+@app.route('/message/<int:message_id>/comments')
+def message_comments(message_id):
+    try:
+        comments, next_cursor = fetch_comment_page(get_db().cursor(), message_id,
+                                                   before=request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+    return jsonify({"comments": [comment_to_dict(comment) for comment in comments],
+                    "next_cursor": next_cursor})
+
 @app.route('/add_reaction/<int:message_id>/<reaction>')
 def add_reaction(message_id, reaction):
-    db = get_db()
-    cursor = db.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO reactions (message_id, reaction, count)
-            VALUES (?, ?, 1)
-            ON CONFLICT(message_id, reaction) 
-            DO UPDATE SET count = count + 1
-        ''', (message_id, reaction))
-        db.commit()
-        
-        cursor.execute('''
-            SELECT reaction, count
-            FROM reactions
-            WHERE message_id = ?
-        ''', (message_id,))
-        reactions = dict(cursor.fetchall())
-        
-        socketio.emit('reaction_update', {
-            'message_id': message_id,
-            'reactions': reactions
-        })
-        
-        return 'OK', 200
-    except Exception as e:
-        print(f"Error adding reaction: {e}")
-        return 'Error', 500
-
-BASE_HTML = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Rad Message Board</title>
-    <style>
-        :root {
-            --bg-color: #000;
-            --text-color: #fff;
-            --border-color: #fff;
-            --input-bg-color: #000;
-            --input-text-color: #fff;
-            --button-bg-color: #fff;
-            --button-text-color: #000;
-            --tag-bg-color: #fff;
-            --tag-text-color: #000;
-        }
-        body {
-            font-family: 'Courier New', monospace;
-            background-color: var(--bg-color);
-            color: var(--text-color);
-            margin: 0;
-            padding: 20px;
-            transition: background-color 0.3s, color 0.3s;
-        }
-        .container {
-            max-width: 800px;
-            margin: 0 auto;
-        }
-        h1, h2 {
-            border-bottom: 4px solid var(--border-color);
-            padding-bottom: 10px;
-        }
-        .message, .comment {
-            border: 4px solid var(--border-color);
-            padding: 10px;
-            margin-bottom: 20px;
-        }
-        .message-content, .comment-content {
-            margin-bottom: 10px;
-            word-wrap: break-word;
-        }
-        .message-meta, .comment-meta {
-            font-size: 0.8em;
-            color: #ccc;
-            margin-bottom: 10px;
-        }
-        form {
-            margin-bottom: 20px;
-        }
-        input[type="text"], textarea {
-            width: calc(100% - 24px);
-            padding: 10px;
-            margin-bottom: 10px;
-            background-color: var(--input-bg-color);
-            color: var(--input-text-color);
-            border: 2px solid var(--border-color);
-        }
-        input[type="submit"], button {
-            background-color: var(--button-bg-color);
-            color: var(--button-text-color);
-            border: none;
-            padding: 10px 20px;
-            cursor: pointer;
-        }
-        .comments-section {
-            margin-top: 10px;
-            padding-top: 10px;
-            border-top: 2px solid var(--border-color);
-        }
-        .tag {
-            display: inline-block;
-            background-color: var(--tag-bg-color);
-            color: var(--tag-text-color);
-            padding: 2px 5px;
-            margin-right: 5px;
-            font-size: 0.8em;
-        }
-        .tag-cloud {
-            margin-bottom: 20px;
-        }
-        #generated-image {
-            max-width: 100%;
-            height: auto;
-            margin-top: 10px;
-        }
-    </style>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.js"></script>
-    <script>
-        var socket = io();
-        
-        function generateImage() {
-            var prompt = document.getElementById('image-prompt').value;
-            fetch('/generate_image', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                },
-                body: 'prompt=' + encodeURIComponent(prompt)
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.error) {
-                    alert('Error: ' + data.error);
-                } else {
-                    document.getElementById('generated-image').src = 'data:image/png;base64,' + data.image_data;
-                    document.getElementById('generated-image').style.display = 'block';
-                    document.getElementById('image-data').value = data.image_data;
-                }
-            });
-        }
-        
-        socket.on('new_message', function(message) {
-            var messagesContainer = document.querySelector('.container');
-            var newMessageElement = document.createElement('div');
-            newMessageElement.className = 'message';
-            newMessageElement.innerHTML = `
-                <div class="message-content">${message.content}</div>
-                ${message.image_data ? `<img src="data:image/png;base64,${message.image_data}" alt="Generated Image" style="max-width: 100%; height: auto;">` : ''}
-                <div class="message-meta">
-                    Posted on ${message.timestamp}
-                </div>
-                <div class="message-tags">
-                    ${message.tags.map(tag => `<span class="tag">${tag}</span>`).join('')}
-                </div>
-                <div class="comments-section"></div>
-                <form action="/post_comment/${message.id}" method="post">
-                    <input type="text" name="content" placeholder="Add a comment" required>
-                    <input type="submit" value="Post Comment">
-                </form>
-                <div class="reactions">
-                    <button onclick="addReaction(${message.id}, '👍')">👍 0</button>
-                    <button onclick="addReaction(${message.id}, '❤️')">❤️ 0</button>
-                    <button onclick="addReaction(${message.id}, '😂')">😂 0</button>
-                    <button onclick="addReaction(${message.id}, '😮')">😮 0</button>
-                </div>
-            `;
-            messagesContainer.insertBefore(newMessageElement, messagesContainer.firstChild);
-        });
-        
-        socket.on('new_comment', function(comment) {
-            var messageElement = document.querySelector(`[data-message-id="${comment.message_id}"]`);
-            if (messageElement) {
-                var commentsSection = messageElement.querySelector('.comments-section');
-                var newCommentElement = document.createElement('div');
-                newCommentElement.className = 'comment';
-                newCommentElement.innerHTML = `
-                    <div class="comment-content">${comment.content}</div>
-                    <div class="comment-meta">
-                        Posted on ${comment.timestamp}
-                    </div>
-                `;
-                commentsSection.appendChild(newCommentElement);
-            }
-        });
-
-        socket.on('reaction_update', function(data) {
-            var messageElement = document.querySelector(`[data-message-id="${data.message_id}"]`);
-            if (messageElement) {
-                var reactionsElement = messageElement.querySelector('.reactions');
-                if (reactionsElement) {
-                    for (var reaction in data.reactions) {
-                        var button = reactionsElement.querySelector(`[data-reaction="${reaction}"]`);
-                        if (button) {
-                            button.textContent = `${reaction} ${data.reactions[reaction]}`;
-                        }
-                    }
-                }
-            }
-        });
-
-        function addReaction(messageId, reaction) {
-            fetch(`/add_reaction/${messageId}/${reaction}`, {method: 'GET'})
-                .then(response => {
-                    if (!response.ok) {
-                        throw new Error('Network response was not ok');
-                    }
-                })
-                .catch(error => console.error('Error:', error));
-        }
-    </script>
-</head>
-<body>
-    <div class="container">
-        <h1>Rad Message Board</h1>
-        {% if popular_tags %}
-            <div class="tag-cloud">
-                <h2>Popular Tags</h2>
-                {% for tag, count in popular_tags %}
-                    <a href="{{ url_for('view_tag', tag_name=tag) }}" class="tag">{{ tag }} ({{ count }})</a>
-                {% endfor %}
-            </div>
-        {% endif %}
-        <form action="{{ url_for('post_message') }}" method="post">
-            <textarea name="content" placeholder="What's on your mind?" required></textarea>
-            <input type="text" name="tags" placeholder="Tags (comma-separated)">
-            <input type="text" id="image-prompt" placeholder="Image generation prompt">
-            <button type="button" onclick="generateImage()">Generate Image</button>
-            <img id="generated-image" src="" alt="Generated Image" style="display:none;">
-            <input type="hidden" id="image-data" name="image_data">
-            <input type="submit" value="Post Message">
-        </form>
-        {% for message in messages %}
-            <div class="message" data-message-id="{{ message[0] }}">
-                <div class="message-content">{{ message[1] }}</div>
-                {% if message[2] %}
-                    <img src="data:image/png;base64,{{ message[2] }}" alt="Generated Image" style="max-width: 100%; height: auto;">
-                {% endif %}
-                <div class="message-meta">
-                    Posted on {{ message[3] }}
-                </div>
-                {% if message[5] %}
-                    <div class="message-tags">
-                        {% for tag in message[5] %}
-                            <a href="{{ url_for('view_tag', tag_name=tag) }}" class="tag">{{ tag }}</a>
-                        {% endfor %}
-                    </div>
-                {% endif %}
-                <div class="reactions">
-                    <button onclick="addReaction({{ message[0] }}, '👍')" data-reaction="👍">👍 {{ message[6].get('👍', 0) }}</button>
-                    <button onclick="addReaction({{ message[0] }}, '❤️')" data-reaction="❤️">❤️ {{ message[6].get('❤️', 0) }}</button>
-                    <button onclick="addReaction({{ message[0] }}, '😂')" data-reaction="😂">😂 {{ message[6].get('😂', 0) }}</button>
-                    <button onclick="addReaction({{ message[0] }}, '😮')" data-reaction="😮">😮 {{ message[6].get('😮', 0) }}</button>
-                </div>
-                {% if message[4] %}
-                    <div class="comments-section">
-                        <h3>Comments:</h3>
-                        {% for comment in message[4] %}
-                            <div class="comment">
-                                <div class="comment-content">{{ comment[0] }}</div>
-                                <div class="comment-meta">
-                                    Posted on {{ comment[1] }}
-                                </div>
-                            </div>
-                        {% endfor %}
-                    </div>
-                {% endif %}
-                <form action="{{ url_for('post_comment', message_id=message[0]) }}" method="post">
-                    <input type="text" name="content" placeholder="Add a comment" required>
-                    <input type="submit" value="Post Comment">
-                </form>
-            </div>
-        {% endfor %}
-    </div>
-</body>
-</html>
-'''
+    # Counted in memory; the flusher writes and broadcasts in batches
+    reaction_accumulator.add(message_id, reaction)
+    return 'OK', 200
+
+@app.cli.command('import-jsonl')
+@click.argument('path', type=click.File('rb'))
+def import_jsonl_command(path):
+    """Bulk-import messages and comments from a JSON lines file."""
+    started = time.perf_counter()
+    counts = import_board(path)
+    elapsed = time.perf_counter() - started
+    rows = counts['messages'] + counts['comments']
+    click.echo(f"Imported {counts['messages']} messages and {counts['comments']} comments "
+               f"({counts['skipped']} skipped) in {elapsed:.1f}s, {rows / max(elapsed, 1e-9):.0f} rows/s")
+
+@app.cli.command('export')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--since-message-id', type=int, default=0, help='Only messages with a higher id.')
+@click.option('--since-comment-id', type=int, default=0, help='Only comments with a higher id.')
+@click.option('--since-timestamp', default=None, help='Only rows posted after this time.')
+def export_command(directory, since_message_id, since_comment_id, since_timestamp):
+    """Export the board as NDJSON plus image files into DIRECTORY."""
+    started = time.perf_counter()
+    with db_pool.connection() as db:
+        checkpoint = export_to_directory(db, image_store, directory,
+                                         since_message_id=since_message_id,
+                                         since_comment_id=since_comment_id,
+                                         since_timestamp=since_timestamp)
+    click.echo(f"Exported in {time.perf_counter() - started:.1f}s. Next incremental export: "
+               f"--since-message-id {checkpoint['message_id']} "
+               f"--since-comment-id {checkpoint['comment_id']}")
+
+@app.cli.command('restore')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+def restore_command(directory):
+    """Restore an export made with 'flask export', keeping its ids."""
+    started = time.perf_counter()
+    images = restore_images(image_store, directory)
+    counts = import_board(read_export(directory), restore=True)
+    click.echo(f"Restored {counts['messages']} messages, {counts['comments']} comments and "
+               f"{images} images in {time.perf_counter() - started:.1f}s")
+
+@app.cli.command('check-aggregates')
+@click.option('--rebuild', is_flag=True, help='Recompute all counters from the base tables.')
+def check_aggregates_command(rebuild):
+    """Verify tag_counts and per-message reaction counts."""
+    with db_pool.connection() as db:
+        if rebuild:
+            rebuild_aggregates(db.cursor())
+            db.commit()
+            click.echo('Aggregates rebuilt.')
+        problems = check_aggregates(db.cursor())
+    for problem in problems:
+        click.echo(problem)
+    if problems:
+        raise SystemExit(1)
+    click.echo('Aggregates are consistent.')
 
 @socketio.on('connect')
 def handle_connect():
-    print('Client connected')
+    socket_clients.inc()
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print('Client disconnected')
+    socket_clients.dec()
+
+def subscription_rooms(data):
+    if not isinstance(data, dict):
+        return []
+    rooms = [room for room in data.get('feeds') or []
+             if isinstance(room, str) and (room == 'feed' or room.startswith('tag:'))]
+    message_ids = [message_id for message_id in data.get('messages') or []
+                   if isinstance(message_id, int)]
+    rooms.extend(message_room(message_id) for message_id in message_ids[:MAX_SUBSCRIBED_MESSAGES])
+    return rooms
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    rooms = subscription_rooms(data)
+    for room in rooms:
+        join_room(room)
+    # Rooms are joined first, so nothing falls between the replay and live events
+    since = data.get('since') if isinstance(data, dict) else None
+    if isinstance(since, int):
+        version = data.get('version')
+        feeds = [room for room in rooms if not room.startswith('message:')]
+        message_ids = [int(room.split(':', 1)[1]) for room in rooms if room.startswith('message:')]
+        emit('changes', replay_changes(since, feeds, message_ids,
+                                       version=version if isinstance(version, int) else None))
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    for room in subscription_rooms(data):
+        leave_room(room)
 
 if __name__ == '__main__':
     socketio.run(app, debug=True)
\ No newline at end of file
@@ -0,0 +1,80 @@
+"""Compare a feed page that loads every comment with the latest-comments preview.
+
+    python benchmarks/bench_comments.py --messages 100 --comments 10 100 1000
+
+For each thread size, seeds a board where every message has that many
+comments, then times loading one feed page's comments in full against the
+latest-comments window, and one page of /message/<id>/comments.
+"""
+import argparse
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+from common import load_app, seed_board, temp_db_path
+
+from feed import COMMENT_PAGE_SIZE, COMMENT_PREVIEW, PAGE_SIZE, fetch_comment_page, load_comments
+
+
+def load_all_comments(cursor, message_ids):
+    # What the feed did before comments were windowed
+    comments = defaultdict(list)
+    cursor.execute(f'''
+        SELECT message_id, content, timestamp
+        FROM comments
+        WHERE message_id IN ({','.join('?' * len(message_ids))})
+        ORDER BY message_id, timestamp ASC, id ASC
+    ''', message_ids)
+    for message_id, content, timestamp in cursor.fetchall():
+        comments[message_id].append((content, timestamp))
+    return comments
+
+
+def best_of(repeat, run):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--comments', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'comments':>9} {'all ms':>8} {'rows':>7} {'window ms':>10} {'rows':>6} {'page ms':>8}")
+    for thread_size in args.comments:
+        path = temp_db_path('bench-comments')
+        try:
+            load_app(path)
+            seed_board(path, messages=args.messages, comments_per_message=thread_size)
+            db = sqlite3.connect(path)
+            cursor = db.cursor()
+            cursor.execute("SELECT id FROM messages ORDER BY timestamp DESC, id DESC LIMIT ?",
+                           (PAGE_SIZE,))
+            message_ids = [row[0] for row in cursor.fetchall()]
+
+            full = best_of(args.repeat, lambda: load_all_comments(cursor, message_ids))
+            windowed = best_of(args.repeat, lambda: load_comments(cursor, message_ids))
+            page = best_of(args.repeat, lambda: fetch_comment_page(cursor, message_ids[0]))
+            full_rows = sum(len(rows) for rows in load_all_comments(cursor, message_ids).values())
+            window_rows = sum(len(rows) for rows in load_comments(cursor, message_ids).values())
+            print(f"{thread_size:>9} {full * 1000:>8.2f} {full_rows:>7} {windowed * 1000:>10.2f} "
+                  f"{window_rows:>6} {page * 1000:>8.2f}")
+            db.close()
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+    print(f'({PAGE_SIZE} messages per page, {COMMENT_PREVIEW} comments shown per message, '
+          f'{COMMENT_PAGE_SIZE} per comment page)')
+
+
+if __name__ == '__main__':
+    main()
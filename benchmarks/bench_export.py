@@ -0,0 +1,86 @@
+"""Time a full NDJSON export and its restore into an empty board.
+
+    python benchmarks/bench_export.py --messages 1000000 --comments 1
+"""
+import argparse
+import os
+import resource
+import sqlite3
+import time
+import tracemalloc
+
+from common import load_app, seed_board, temp_db_path
+
+from db import connect, migrate
+from export import export_ndjson
+from posts import TagResolver, import_jsonl
+
+
+def count_rows(path):
+    db = sqlite3.connect(path)
+    counts = db.execute('''
+        SELECT (SELECT COUNT(*) FROM messages), (SELECT COUNT(*) FROM comments),
+               (SELECT COUNT(*) FROM message_tags), (SELECT COALESCE(SUM(count), 0) FROM reactions)
+    ''').fetchone()
+    db.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--comments', type=int, default=1)
+    args = parser.parse_args()
+
+    source = temp_db_path('bench-export')
+    target = temp_db_path('bench-restore')
+    dump = f'{source}.ndjson'
+    try:
+        load_app(source)
+        seed_board(source, messages=args.messages, comments_per_message=args.comments)
+
+        db = connect(source)
+        tracemalloc.start()
+        started = time.perf_counter()
+        lines = 0
+        with open(dump, 'w', encoding='utf-8') as out:
+            for line in export_ndjson(db):
+                out.write(line)
+                lines += 1
+        export_time = time.perf_counter() - started
+        _, export_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        db.close()
+        size_mb = os.path.getsize(dump) / 1e6
+        print(f'export:  {lines:,} lines, {size_mb:.1f} MB in {export_time:.2f}s '
+              f'({lines / export_time:,.0f} rows/s, peak Python heap {export_peak / 1e6:.1f} MB)')
+
+        db = connect(target)
+        migrate(db)
+        tracemalloc.start()
+        started = time.perf_counter()
+        with open(dump, encoding='utf-8') as lines_in:
+            counts = import_jsonl(db, TagResolver(), lines_in, preserve_ids=True)
+        restore_time = time.perf_counter() - started
+        _, restore_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        db.close()
+        rows = counts['messages'] + counts['comments']
+        print(f'restore: {rows:,} rows in {restore_time:.2f}s '
+              f'({rows / restore_time:,.0f} rows/s, peak Python heap {restore_peak / 1e6:.1f} MB)')
+        print(f'max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
+
+        expected, restored = count_rows(source), count_rows(target)
+        status = 'match' if expected == restored else 'MISMATCH'
+        print(f'messages, comments, tag links, reactions: {expected} -> {restored} ({status})')
+    finally:
+        for path in (source, target):
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+        if os.path.exists(dump):
+            os.unlink(dump)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Measure Socket.IO fan-out bytes and latency with many simulated clients.
+
+    python benchmarks/bench_fanout.py --clients 1000 --tags 20 --events 20
+
+Clients are in-process Socket.IO test clients, each viewing either the main
+feed or one tag page with a page of messages. The same post/comment/reaction
+traffic is sent twice: once broadcast to everyone with the old inline-base64
+payload, and once through the real routes, which use rooms and image URLs.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import time
+
+from common import load_app, temp_db_path
+
+
+def received_bytes(clients):
+    total = 0
+    for client in clients:
+        for packet in client.get_received():
+            total += len(json.dumps(packet['args']))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=20)
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--image-kb', type=int, default=1500,
+                        help='size of the inline base64 image in the legacy payload')
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    path = temp_db_path('bench-fanout')
+    os.environ.setdefault('REACTION_FLUSH_MS', '50')
+    app_module = load_app(path)
+    app, socketio = app_module.app, app_module.socketio
+    http = app.test_client()
+    try:
+        for i in range(50):
+            http.post('/post_message', data={'content': f'seed {i}', 'tags': f'tag{i % args.tags}'})
+
+        clients = []
+        for _ in range(args.clients):
+            client = socketio.test_client(app)
+            tag = rng.randrange(args.tags + 1)
+            client.emit('subscribe', {
+                'feeds': ['feed' if tag == args.tags else f'tag:tag{tag}'],
+                'messages': rng.sample(range(1, 51), 20),
+            })
+            clients.append(client)
+        received_bytes(clients)
+
+        legacy_image = base64.b64encode(os.urandom(args.image_kb * 768)).decode()
+        started = time.perf_counter()
+        for i in range(args.events):
+            socketio.emit('new_message', {'id': 1000 + i, 'content': 'legacy', 'image_data': legacy_image,
+                                          'timestamp': '', 'tags': ['tag0'], 'reactions': {}})
+            socketio.emit('new_comment', {'message_id': 1, 'content': 'legacy', 'timestamp': ''})
+            socketio.emit('reaction_update', {'message_id': 1, 'reactions': {'👍': i}})
+        legacy_time = time.perf_counter() - started
+        legacy_bytes = received_bytes(clients)
+
+        started = time.perf_counter()
+        for i in range(args.events):
+            http.post('/post_message', data={'content': f'new {i}', 'tags': f'tag{i % args.tags}'})
+            http.post(f'/post_comment/{rng.randint(1, 50)}', data={'content': 'comment'})
+            http.get(f'/add_reaction/{rng.randint(1, 50)}/👍')
+        app_module.reaction_accumulator.flush()
+        rooms_time = time.perf_counter() - started
+        rooms_bytes = received_bytes(clients)
+
+        for client in clients:
+            client.disconnect()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+    events = args.events * 3
+    print(f'{args.clients} clients, {events} events')
+    print(f"{'mode':<10} {'bytes sent':>14} {'per event':>12} {'ms per event':>13}")
+    print(f"{'broadcast':<10} {legacy_bytes:>14,} {legacy_bytes // events:>12,} {legacy_time * 1000 / events:>13.2f}")
+    print(f"{'rooms':<10} {rooms_bytes:>14,} {rooms_bytes // events:>12,} {rooms_time * 1000 / events:>13.2f}")
+
+
+if __name__ == '__main__':
+    main()
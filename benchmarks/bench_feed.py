@@ -0,0 +1,96 @@
+"""Compare the old per-message N+1 feed load with the batched feed loader.
+
+    python benchmarks/bench_feed.py --sizes 100 1000 5000 20000
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+from common import QueryCounter, load_app, seed_board, temp_db_path
+
+from feed import assemble_feed
+
+FEED_SQL = '''
+    SELECT messages.id, messages.content, messages.image_data, messages.timestamp
+    FROM messages
+    ORDER BY messages.timestamp DESC
+'''
+
+
+def load_n_plus_one(cursor):
+    # The loop index() used before feed.assemble_feed existed
+    cursor.execute(FEED_SQL)
+    messages = cursor.fetchall()
+    for i, message in enumerate(messages):
+        cursor.execute('''
+            SELECT comments.content, comments.timestamp
+            FROM comments
+            WHERE comments.message_id = ?
+            ORDER BY comments.timestamp ASC
+        ''', (message[0],))
+        comments = cursor.fetchall()
+        cursor.execute('''
+            SELECT tags.name
+            FROM tags
+            JOIN message_tags ON tags.id = message_tags.tag_id
+            WHERE message_tags.message_id = ?
+        ''', (message[0],))
+        tags = [tag[0] for tag in cursor.fetchall()]
+        cursor.execute('''
+            SELECT reaction, count
+            FROM reactions
+            WHERE message_id = ?
+        ''', (message[0],))
+        reactions = dict(cursor.fetchall())
+        messages[i] = message + (comments, tags, reactions)
+    return messages
+
+
+def load_batched(cursor):
+    cursor.execute('''
+        SELECT messages.id, messages.content, messages.image_data, messages.timestamp,
+               messages.reaction_counts, messages.comment_count
+        FROM messages
+        ORDER BY messages.timestamp DESC
+    ''')
+    return assemble_feed(cursor, cursor.fetchall())
+
+
+def measure(db, loader, repeat):
+    best = None
+    for _ in range(repeat):
+        with QueryCounter(db) as counter:
+            started = time.perf_counter()
+            loader(db.cursor())
+            elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return counter.count, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000, 20000])
+    parser.add_argument('--comments', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'messages':>9} {'n+1 queries':>12} {'n+1 ms':>9} {'batched queries':>16} {'batched ms':>11}")
+    for size in args.sizes:
+        path = temp_db_path('bench-feed')
+        try:
+            load_app(path)
+            seed_board(path, messages=size, comments_per_message=args.comments)
+            db = sqlite3.connect(path)
+            old_queries, old_time = measure(db, load_n_plus_one, args.repeat)
+            new_queries, new_time = measure(db, load_batched, args.repeat)
+            db.close()
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+        print(f"{size:>9} {old_queries:>12} {old_time * 1000:>9.1f} "
+              f"{new_queries:>16} {new_time * 1000:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
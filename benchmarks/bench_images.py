@@ -0,0 +1,99 @@
+"""Measure image ingestion throughput per encoder process.
+
+    python benchmarks/bench_images.py --processes 0 1 2 4 --uploads 40 --size 2048x1536
+
+Each round stores the same set of distinct photo-like uploads in a fresh
+ImageStore, with the given number of EncoderPool processes (0 encodes on
+the calling threads), from --threads threads as request workers would.
+Throughput can only grow with processes up to the number of cores.
+"""
+import argparse
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from common import ROOT  # noqa: F401  (puts the repo on sys.path)
+
+from PIL import Image, ImageFilter
+
+from images import EncoderPool, ImageStore
+
+
+def make_uploads(count, size, image_format, rng):
+    # Blurred noise over a gradient: compresses roughly like a photo, and
+    # every upload differs so none is deduplicated
+    uploads = []
+    gradient = Image.linear_gradient('L').resize(size).convert('RGB')
+    for _ in range(count):
+        noise = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+        image = Image.blend(gradient, noise.filter(ImageFilter.GaussianBlur(2)), 0.5)
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, **({'quality': 95} if image_format == 'JPEG' else {}))
+        uploads.append(buffer.getvalue())
+    return uploads
+
+
+def ingest(store, uploads, threads):
+    pending = list(uploads)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                raw = pending.pop()
+            store.put_bytes(raw)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--uploads', type=int, default=40)
+    parser.add_argument('--size', default='2048x1536', help='upload dimensions, WxH')
+    parser.add_argument('--format', default='PNG', choices=('PNG', 'JPEG'))
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--max-dimension', type=int, default=2048)
+    parser.add_argument('--max-kb', type=int, default=500)
+    args = parser.parse_args()
+
+    size = tuple(int(part) for part in args.size.split('x'))
+    uploads = make_uploads(args.uploads, size, args.format, random.Random(1))
+    upload_kb = sum(map(len, uploads)) / len(uploads) / 1024
+
+    print(f'{os.cpu_count()} cores, {args.uploads} {args.format} uploads of {args.size}, '
+          f'{upload_kb:.0f} KB on average')
+    print(f"{'processes':>9} {'images/s':>9} {'per proc':>9} {'ms/image':>9} {'stored KB':>10}")
+    for processes in args.processes:
+        root = tempfile.mkdtemp(prefix='bench-images-')
+        encoder = EncoderPool(processes) if processes > 0 else None
+        try:
+            store = ImageStore(root, max_dimensions=(args.max_dimension,) * 2,
+                               max_bytes=args.max_kb * 1024, encoder=encoder)
+            elapsed = ingest(store, uploads, args.threads)
+            stored = [os.path.getsize(os.path.join(directory, name))
+                      for directory, _, names in os.walk(root)
+                      for name in names if not name.endswith('.thumb.webp')]
+            rate = len(uploads) / elapsed
+            print(f"{processes:>9} {rate:>9.1f} {rate / max(processes, 1):>9.1f} "
+                  f"{elapsed / len(uploads) * 1000:>9.0f} {sum(stored) / len(stored) / 1024:>10.0f}")
+        finally:
+            if encoder is not None:
+                encoder.shutdown()
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Time feed pages at increasing depth to check keyset pages cost the same.
+
+    python benchmarks/bench_pagination.py --messages 20000 --depths 1 10 100 900
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+from common import QueryCounter, load_app, seed_board, temp_db_path
+
+from feed import PAGE_SIZE, fetch_feed_page
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 10, 100, 900])
+    parser.add_argument('--tag', default=None, help='paginate a tag page instead of the main feed')
+    args = parser.parse_args()
+
+    path = temp_db_path('bench-pages')
+    try:
+        load_app(path)
+        seed_board(path, messages=args.messages)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+
+        # Walk the feed once to collect the cursor at the start of each page
+        cursors = [None]
+        after = None
+        while len(cursors) <= max(args.depths):
+            _, after = fetch_feed_page(cursor, tag_name=args.tag, after=after)
+            if after is None:
+                break
+            cursors.append(after)
+
+        print(f"{'page':>6} {'queries':>8} {'ms':>8}")
+        for depth in args.depths:
+            if depth > len(cursors):
+                print(f"{depth:>6} {'-':>8} {'(past end)':>8}")
+                continue
+            with QueryCounter(db) as counter:
+                started = time.perf_counter()
+                fetch_feed_page(cursor, tag_name=args.tag, after=cursors[depth - 1])
+                elapsed = time.perf_counter() - started
+            print(f"{depth:>6} {counter.count:>8} {elapsed * 1000:>8.2f}")
+        db.close()
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+    print(f'({PAGE_SIZE} messages per page)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Compare time to first byte and memory of buffered and streamed feed pages.
+
+    python benchmarks/bench_render.py --messages 5000 --sizes 20 200 2000
+
+"buffered" is the old approach: board.html parsed with render_template_string
+on every request and the whole page built in memory before it is returned.
+"streamed" is what the routes do now: the compiled template is streamed and
+each message card is rendered as it is sent. Every measurement runs in a
+fresh process so its RSS high-water mark is its own.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from common import load_app, seed_board, temp_db_path
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(path, mode, size):
+    app = load_app(path)
+    from flask import render_template_string
+    from feed import fetch_feed_page
+
+    with app.app.test_request_context('/'):
+        messages, _ = fetch_feed_page(app.get_db().cursor(), limit=size)
+        source = app.app.jinja_loader.get_source(app.app.jinja_env, 'board.html')[0]
+        # Cards are rendered by both modes, not served from the fragment cache
+        app.render_cache.clear()
+        rss_before = max_rss_mb()
+        tracemalloc.start()
+        started = time.perf_counter()
+        if mode == 'buffered':
+            body = render_template_string(source, feed_room='feed', fragments=[
+                app.render_message(message) for message in messages])
+            first_byte = time.perf_counter() - started
+            size_bytes = len(body.encode())
+        else:
+            first_byte = None
+            size_bytes = 0
+            for chunk in app.stream_page(feed_room='feed', fragments=(
+                    app.render_message(message) for message in messages)):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+                size_bytes += len(chunk.encode())
+        total = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'ttfb': first_byte, 'total': total, 'peak_heap': peak, 'bytes': size_bytes,
+            'rss_growth': max_rss_mb() - rss_before}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 200, 2000],
+                        help='messages per rendered page')
+    parser.add_argument('--child', nargs=3, metavar=('DB', 'MODE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        path, mode, size = args.child
+        print(json.dumps(measure(path, mode, int(size))))
+        return
+
+    path = temp_db_path('bench-render')
+    try:
+        load_app(path)
+        seed_board(path, messages=args.messages)
+        print(f"{'page':>6} {'mode':<9} {'KB':>8} {'TTFB ms':>9} {'total ms':>9} "
+              f"{'heap MB':>8} {'RSS +MB':>8}")
+        for size in args.sizes:
+            for mode in ('buffered', 'streamed'):
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--child', path, mode, str(size)],
+                    capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{size:>6} {mode:<9} {result['bytes'] / 1024:>8.0f} "
+                      f"{result['ttfb'] * 1000:>9.1f} {result['total'] * 1000:>9.1f} "
+                      f"{result['peak_heap'] / 1e6:>8.1f} {result['rss_growth']:>8.1f}")
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Compare FTS5 search with a LIKE scan over messages and comments.
+
+    python benchmarks/bench_search.py --messages 100000 --comments 1
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+from common import load_app, seed_board, temp_db_path
+
+from search import search
+
+# Without an index there is nothing to rank by, so a LIKE search has to
+# collect every match before it can order and page them
+LIKE_SQL = '''
+    SELECT 'message', id, NULL, timestamp FROM messages WHERE content LIKE :pattern
+    UNION ALL
+    SELECT 'comment', message_id, id, timestamp FROM comments WHERE content LIKE :pattern
+    ORDER BY timestamp DESC
+'''
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--comments', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    # The seeded vocabulary is small, so single words match a large share of rows
+    parser.add_argument('--queries', nargs='+', default=['neon', 'pixel synth', 'nomatchword'])
+    args = parser.parse_args()
+
+    path = temp_db_path('bench-search')
+    try:
+        load_app(path)
+        seed_board(path, messages=args.messages, comments_per_message=args.comments)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        cursor.execute("SELECT (SELECT COUNT(*) FROM messages) + (SELECT COUNT(*) FROM comments)")
+        print(f'{cursor.fetchone()[0]:,} rows indexed')
+
+        print(f"{'query':<14} {'LIKE ms':>9} {'FTS5 ms':>9} {'FTS5 hits':>10}")
+        for query in args.queries:
+            # LIKE can only look for the phrase as typed
+            _, like_time = timed(lambda: cursor.execute(LIKE_SQL, {'pattern': f'%{query}%'}).fetchall(),
+                                 args.repeat)
+            (hits, _), fts_time = timed(lambda: search(cursor, query), args.repeat)
+            print(f"{query:<14} {like_time * 1000:>9.1f} {fts_time * 1000:>9.1f} {len(hits):>10}")
+        db.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Compare catching up through /changes with reloading the feed page.
+
+    python benchmarks/bench_sync.py --messages 5000 --missed 10 100 500
+
+For each gap size, posts that many messages, comments and reactions after
+a client's last seen change, then times and sizes the replay against a
+fresh (uncached) render of the first feed page.
+"""
+import argparse
+import os
+import random
+import time
+
+from common import REACTIONS, load_app, seed_board, temp_db_path
+
+
+def timed_get(client, url):
+    started = time.perf_counter()
+    response = client.get(url)
+    body = response.get_data()
+    return time.perf_counter() - started, len(body), response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--missed', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault('REACTION_FLUSH_MS', '50')
+    path = temp_db_path('bench-sync')
+    rng = random.Random(1)
+    try:
+        app_module = load_app(path)
+        seed_board(path, messages=args.messages)
+        client = app_module.app.test_client()
+
+        print(f"{'missed':>7} {'replay ms':>10} {'replay KB':>10} {'page ms':>9} {'page KB':>9}")
+        for missed in args.missed:
+            _, _, response = timed_get(client, '/changes?since=0')
+            since = response.get_json()['last_seq']
+            for number in range(missed):
+                kind = number % 3
+                if kind == 0:
+                    client.post('/post_message', data={'content': f'missed {number}', 'tags': 'tag1'})
+                elif kind == 1:
+                    client.post(f'/post_comment/{rng.randint(1, args.messages)}',
+                                data={'content': f'missed {number}'})
+                else:
+                    client.get(f'/add_reaction/{rng.randint(1, args.messages)}/{rng.choice(REACTIONS)}')
+            app_module.reaction_accumulator.flush()
+
+            replay = page = (0.0, 0)
+            for _ in range(args.repeat):
+                elapsed, size, _ = timed_get(client, f'/changes?since={since}')
+                replay = (replay[0] + elapsed, size)
+                app_module.render_cache.clear()
+                elapsed, size, _ = timed_get(client, '/')
+                page = (page[0] + elapsed, size)
+            print(f"{missed:>7} {replay[0] / args.repeat * 1000:>10.2f} {replay[1] / 1024:>10.1f} "
+                  f"{page[0] / args.repeat * 1000:>9.2f} {page[1] / 1024:>9.1f}")
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Measure HTTP throughput as serve.py runs more worker processes.
+
+    python benchmarks/bench_workers.py --workers 1 2 4 --clients 32 --seconds 10
+
+Each round starts serve.py on a fresh copy of a seeded board with the SQLite
+message queue, checks that an event posted to the last worker reaches a
+Socket.IO client of the first, then has client threads request the paths
+round-robin over the worker ports. Throughput can only scale with workers
+up to the number of cores, which are shared with the load generator here.
+"""
+import argparse
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import closing
+
+import requests
+import socketio
+
+from common import (ROOT, load_app, percentile, seed_board, server_async_mode, temp_db_path,
+                    wait_for_port)
+
+
+def check_fanout(ports):
+    received = threading.Event()
+    client = socketio.Client()
+    client.on('new_message', lambda message: received.set())
+    client.connect(f'http://127.0.0.1:{ports[0]}')
+    client.emit('subscribe', {'feeds': ['feed']})
+    time.sleep(0.5)
+    requests.post(f'http://127.0.0.1:{ports[-1]}/post_message', data={'content': 'fan-out check'})
+    delivered = received.wait(5)
+    client.disconnect()
+    return delivered
+
+
+def run_load(ports, paths, clients, seconds):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client(number):
+        session = requests.Session()
+        mine, failed = [], 0
+        request_number = number
+        while time.monotonic() < deadline:
+            port = ports[request_number % len(ports)]
+            path = paths[request_number % len(paths)]
+            request_number += 1
+            started = time.perf_counter()
+            try:
+                ok = session.get(f'http://127.0.0.1:{port}{path}', timeout=30).ok
+            except requests.RequestException:
+                ok = False
+            if ok:
+                mine.append(time.perf_counter() - started)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5600)
+    parser.add_argument('--paths', nargs='+', default=['/', '/api/feed', '/tag/tag1'])
+    args = parser.parse_args()
+
+    seeded = temp_db_path('bench-workers')
+    load_app(seeded)
+    seed_board(seeded, messages=args.messages)
+    # Fold the WAL into the main file so copying that file copies the board
+    with closing(sqlite3.connect(seeded)) as db:
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    print(f"{'workers':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'errors':>7} {'fan-out':>8}")
+    for workers in args.workers:
+        workdir = tempfile.mkdtemp(prefix='bench-workers-')
+        env = dict(os.environ, MESSAGE_BOARD_DB=os.path.join(workdir, 'board.db'),
+                   IMAGE_STORE_DIR=os.path.join(workdir, 'images'))
+        env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+        shutil.copyfile(seeded, env['MESSAGE_BOARD_DB'])
+        # A single worker gets the queue too, so every round pays the same
+        # publishing cost
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'serve.py'), '--workers', str(workers),
+             '--port', str(args.port), '--async-mode', server_async_mode(),
+             '--queue', f"sqlite:///{os.path.join(workdir, 'queue.db')}"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            ports = [args.port + number for number in range(workers)]
+            for port in ports:
+                wait_for_port(port)
+            delivered = check_fanout(ports)
+            latencies, errors = run_load(ports, args.paths, args.clients, args.seconds)
+            print(f"{workers:>7} {len(latencies) / args.seconds:>8.0f} "
+                  f"{percentile(latencies, 0.50) * 1000:>8.1f} "
+                  f"{percentile(latencies, 0.95) * 1000:>8.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>8.1f} "
+                  f"{errors:>7} {'ok' if delivered else 'MISSED':>8}")
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(seeded + suffix):
+            os.unlink(seeded + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Check import_jsonl's handling of id collisions, orphans and malformed records.
+
+    python benchmarks/check_import.py
+
+Each check imports a few hand-written records into a fresh board and looks
+at what landed. Exits non-zero if any check fails, so it can run before
+changes to posts.py are merged.
+"""
+import argparse
+import json
+import os
+import sys
+from contextlib import closing
+
+from common import temp_db_path
+
+from db import connect, migrate
+from posts import TagResolver, import_jsonl
+
+
+def lines(*records):
+    return [json.dumps(record) for record in records]
+
+
+def board_rows(db):
+    return {
+        'messages': db.execute("SELECT id, content FROM messages ORDER BY id").fetchall(),
+        'comments': db.execute("SELECT message_id, content FROM comments ORDER BY id").fetchall(),
+        'tags': db.execute('''
+            SELECT message_tags.message_id, tags.name FROM message_tags
+            JOIN tags ON tags.id = message_tags.tag_id ORDER BY 1, 2
+        ''').fetchall(),
+        'reactions': db.execute(
+            "SELECT message_id, reaction, count FROM reactions ORDER BY 1, 2").fetchall(),
+    }
+
+
+def restore_onto_taken_id(db, resolver):
+    import_jsonl(db, resolver, lines({'type': 'message', 'content': 'local'}))
+    counts = import_jsonl(db, resolver, lines(
+        {'type': 'message', 'id': 1, 'content': 'foreign', 'tags': ['x'], 'reactions': {'👍': 5}},
+        {'type': 'message', 'id': 2, 'content': 'new', 'tags': ['y']},
+        {'type': 'comment', 'id': 1, 'message_id': 1, 'content': 'on foreign'},
+        {'type': 'comment', 'id': 2, 'message_id': 2, 'content': 'on new'},
+    ), preserve_ids=True)
+    assert board_rows(db) == {
+        'messages': [(1, 'local'), (2, 'new')],
+        'comments': [(2, 'on new')],
+        'tags': [(2, 'y')],
+        'reactions': [],
+    }, board_rows(db)
+    assert counts['messages'] == 1 and counts['comments'] == 1 and counts['skipped'] == 2, counts
+
+
+def generated_ids_skip_later_ones(db, resolver):
+    counts = import_jsonl(db, resolver, lines(
+        {'type': 'message', 'content': 'no id'},
+        {'type': 'message', 'id': 1, 'content': 'one'},
+    ), preserve_ids=True)
+    assert board_rows(db)['messages'] == [(1, 'one'), (2, 'no id')], board_rows(db)
+    assert counts['messages'] == 2 and counts['skipped'] == 0, counts
+
+
+def comment_on_unknown_id(db, resolver):
+    for preserve_ids in (False, True):
+        counts = import_jsonl(db, resolver, lines(
+            {'type': 'comment', 'message_id': 99, 'content': 'orphan'},
+        ), preserve_ids=preserve_ids)
+        assert counts['comments'] == 0 and counts['skipped'] == 1, (preserve_ids, counts)
+    assert board_rows(db)['comments'] == [], board_rows(db)
+
+
+def mistyped_fields(db, resolver):
+    counts = import_jsonl(db, resolver, lines(
+        {'type': 'message', 'id': 1, 'content': 'fine', 'tags': ['ok'], 'reactions': {'👍': 1},
+         'timestamp': '2024-01-01 00:00:00'},
+        {'type': 'message', 'id': 2, 'content': 'tags', 'tags': 5},
+        {'type': 'message', 'id': 3, 'content': 'tag list', 'tags': [1]},
+        {'type': 'message', 'id': 4, 'content': 'reactions', 'reactions': [1]},
+        {'type': 'message', 'id': 5, 'content': 'counts', 'reactions': {'👍': 'lots'}},
+        {'type': 'message', 'id': 6, 'content': 'timestamp', 'timestamp': {}},
+        {'type': 'message', 'id': [7], 'content': 'id'},
+        {'type': 'comment', 'message_id': {}, 'content': 'message id'},
+        {'type': 'comment', 'message_id': 1, 'content': 'fine too'},
+    ) + ['[1, 2]', '"text"', '{"no": "type"}'])
+    assert board_rows(db) == {
+        'messages': [(1, 'fine')],
+        'comments': [(1, 'fine too')],
+        'tags': [(1, 'ok')],
+        'reactions': [(1, '👍', 1)],
+    }, board_rows(db)
+    assert counts['skipped'] == 10, counts
+
+
+CHECKS = [restore_onto_taken_id, generated_ids_skip_later_ones, comment_on_unknown_id,
+          mistyped_fields]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    failed = 0
+    for check in CHECKS:
+        path = temp_db_path('check-import')
+        try:
+            with closing(connect(path)) as db:
+                migrate(db)
+                check(db, TagResolver())
+            print(f'ok    {check.__name__}')
+        except AssertionError as e:
+            failed += 1
+            print(f'FAIL  {check.__name__}: {e}')
+        except Exception as e:
+            # A batch that blows up is as much a failure as a wrong result
+            failed += 1
+            print(f'FAIL  {check.__name__}: {type(e).__name__}: {e}')
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import io
+import os
+import random
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+REACTIONS = ['👍', '❤️', '😂', '😮']
+WORDS = ('rad board post image tag comment sqlite flask socket queue cache '
+         'index page feed river mountain neon pixel synth wave').split()
+
+
+def temp_db_path(prefix='bench'):
+    fd, path = tempfile.mkstemp(prefix=f'{prefix}-', suffix='.db')
+    os.close(fd)
+    os.unlink(path)
+    return path
+
+
+def load_app(db_path):
+    """Import app.py against ``db_path`` so db.migrate() builds the schema there."""
+    os.environ['MESSAGE_BOARD_DB'] = db_path
+    # Every benchmark request comes from one address, so per-client rate
+    # limits would measure the limiter instead of the route
+    os.environ.setdefault('RATE_LIMITS', '')
+    sys.modules.pop('app', None)
+    import app
+    return app
+
+
+def _sentence(rng, words=8):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed_images(store, count, size, rng):
+    """Put ``count`` distinct noise images of ``size`` pixels square in the store."""
+    from PIL import Image
+    digests = []
+    for _ in range(count):
+        image = Image.frombytes('RGB', (size, size), rng.randbytes(size * size * 3))
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG')
+        digests.append(store.put_bytes(buffer.getvalue()))
+    return digests
+
+
+def seed_board(db_path, messages=1000, comments_per_message=3, tags=50,
+               tags_per_message=2, seed=1234, image_every=0, image_size=512,
+               image_store=None, distinct_images=20):
+    """Fill a migrated board with synthetic rows.
+
+    With ``image_every`` N and an ``image_store``, every Nth message gets one
+    of ``distinct_images`` noise images of ``image_size`` pixels square.
+    """
+    rng = random.Random(seed)
+    images = []
+    if image_every and image_store is not None:
+        images = seed_images(image_store, distinct_images, image_size, rng)
+    db = sqlite3.connect(db_path)
+    cursor = db.cursor()
+
+    cursor.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)",
+                       [(f'tag{i}',) for i in range(tags)])
+    cursor.execute("SELECT id FROM tags")
+    tag_ids = [row[0] for row in cursor.fetchall()]
+
+    start = time.time() - messages * 60
+    for i in range(messages):
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start + i * 60))
+        image_hash = rng.choice(images) if images and i % image_every == 0 else None
+        cursor.execute("INSERT INTO messages (content, image_hash, timestamp) VALUES (?, ?, ?)",
+                       (_sentence(rng), image_hash, stamp))
+        message_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO comments (message_id, content, timestamp) VALUES (?, ?, ?)",
+            [(message_id, _sentence(rng, 5), stamp) for _ in range(comments_per_message)])
+        cursor.executemany(
+            "INSERT OR IGNORE INTO message_tags (message_id, tag_id) VALUES (?, ?)",
+            [(message_id, tag_id)
+             for tag_id in rng.sample(tag_ids, min(tags_per_message, len(tag_ids)))])
+        cursor.executemany(
+            "INSERT INTO reactions (message_id, reaction, count) VALUES (?, ?, ?)",
+            [(message_id, reaction, rng.randint(1, 50))
+             for reaction in rng.sample(REACTIONS, rng.randint(0, len(REACTIONS)))])
+
+    db.commit()
+    db.close()
+
+
+def server_async_mode():
+    # serve.py makes the caller choose; benchmarks measure threads unless
+    # told otherwise
+    return os.getenv('SOCKETIO_ASYNC_MODE') or 'threading'
+
+
+def wait_for_port(port, host='127.0.0.1', timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'nothing listening on {host}:{port}')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+class QueryCounter:
+    """Counts statements run on a sqlite3 connection via its trace callback."""
+
+    def __init__(self, db):
+        self.db = db
+        self.count = 0
+
+    def _trace(self, statement):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        self.db.set_trace_callback(self._trace)
+        return self
+
+    def __exit__(self, *exc):
+        self.db.set_trace_callback(None)
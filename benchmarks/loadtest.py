@@ -0,0 +1,323 @@
+"""Reproducible load test of the main routes, with saved baselines.
+
+    python benchmarks/loadtest.py --messages 5000 --save baseline.json
+    python benchmarks/loadtest.py --messages 5000 --compare baseline.json
+
+Seeds a synthetic board (in a temporary database, or in --db, which is kept),
+then runs each scenario and reports p50/p95/p99 latency, throughput and
+memory. ``--mode client`` drives the Flask test client in this process, one
+request at a time. ``--mode http`` starts serve.py with --server-workers
+workers (or uses --url) and sends requests from --concurrency threads while
+--sockets Socket.IO clients watch the feed, so new_message delivery latency
+is measured too. A comparison run exits with status 1 when a scenario's p95
+latency or throughput is worse than the baseline by more than --tolerance.
+"""
+import argparse
+import functools
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from common import (REACTIONS, ROOT, load_app, percentile, seed_board, server_async_mode,
+                    temp_db_path, wait_for_port)
+
+SEED = 4242
+
+
+def scenarios(messages, tags):
+    """(name, method, make_request) triples; make_request(rng) -> (path, form data)."""
+    return [
+        ('feed', 'GET', lambda rng: ('/', None)),
+        ('tag', 'GET', lambda rng: (f'/tag/tag{rng.randrange(tags)}', None)),
+        ('post_message', 'POST', lambda rng: ('/post_message', {
+            'content': f'load test {time.time()}', 'tags': f'tag{rng.randrange(tags)}'})),
+        ('post_comment', 'POST', lambda rng: (f'/post_comment/{rng.randint(1, messages)}', {
+            'content': 'load test comment'})),
+        ('add_reaction', 'GET', lambda rng: (
+            f'/add_reaction/{rng.randint(1, messages)}/{quote(rng.choice(REACTIONS))}', None)),
+    ]
+
+
+def summarize(latencies, elapsed, errors):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'rps': len(latencies) / elapsed if elapsed else 0,
+    }
+
+
+def run_client_mode(args, app):
+    client = app.app.test_client()
+    results = {}
+    for name, method, make_request in scenarios(args.messages, args.tags):
+        rng = random.Random(f'{SEED}:{name}')
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            path, data = make_request(rng)
+            request_started = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            response.get_data()  # streamed pages are rendered while being read
+            if response.status_code < 400:
+                latencies.append(time.perf_counter() - request_started)
+            else:
+                errors += 1
+        results[name] = summarize(latencies, time.perf_counter() - started, errors)
+    app.reaction_accumulator.flush()
+    memory = {'client_max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    return results, memory
+
+
+def process_rss_mb(pid):
+    """Resident memory of a process and its children, from /proc (Linux only)."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as children:
+                pending.extend(int(child) for child in children.read().split())
+        except OSError:
+            continue
+    return total / 1024
+
+
+class SocketWatchers:
+    """Socket.IO clients on the feed room that time new_message delivery."""
+
+    def __init__(self, urls, count):
+        import socketio
+        from engineio.payload import Payload
+        # A busy polling transport batches many events per response, more
+        # than python-engineio's client decodes by default (browsers have no
+        # such limit), which would otherwise drop the connection
+        Payload.max_decode_packets = 1000
+        self.lock = threading.Lock()
+        self.delays = []
+        self.clients = []
+        for number in range(count):
+            client = socketio.Client()
+            client.on('new_message', self._received)
+            # Like the page script, join the room again after a reconnect
+            client.on('connect', functools.partial(self._subscribe, client))
+            client.connect(urls[number % len(urls)])
+            self.clients.append(client)
+
+    def _subscribe(self, client):
+        client.emit('subscribe', {'feeds': ['feed']})
+
+    def _received(self, message):
+        # Posts carry their send time, so delivery is timed across processes
+        sent = message['content'].rsplit(' ', 1)[-1]
+        try:
+            delay = time.time() - float(sent)
+        except ValueError:
+            return
+        with self.lock:
+            self.delays.append(delay)
+
+    def close(self):
+        for client in self.clients:
+            client.disconnect()
+
+
+def run_http_mode(args, urls):
+    import requests
+
+    results = {}
+    watchers = SocketWatchers(urls, args.sockets) if args.sockets else None
+    for name, method, make_request in scenarios(args.messages, args.tags):
+        latencies, errors = [], [0]
+        lock = threading.Lock()
+        per_thread = args.requests // args.concurrency
+
+        def worker(number):
+            rng = random.Random(f'{SEED}:{name}:{number}')
+            session = requests.Session()
+            mine, failed = [], 0
+            for index in range(per_thread):
+                path, data = make_request(rng)
+                url = urls[(number + index) % len(urls)] + path
+                request_started = time.perf_counter()
+                try:
+                    ok = session.request(method, url, data=data, timeout=60,
+                                         allow_redirects=False).status_code < 400
+                except requests.RequestException:
+                    ok = False
+                if ok:
+                    mine.append(time.perf_counter() - request_started)
+                else:
+                    failed += 1
+            with lock:
+                latencies.extend(mine)
+                errors[0] += failed
+
+        threads = [threading.Thread(target=worker, args=(number,))
+                   for number in range(args.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results[name] = summarize(latencies, time.perf_counter() - started, errors[0])
+
+    if watchers is not None:
+        time.sleep(5)  # let the last events arrive
+        delays = sorted(watchers.delays)
+        expected = results['post_message']['requests'] * args.sockets
+        results['socket_delivery'] = {
+            'requests': len(delays),
+            'errors': max(expected - len(delays), 0),
+            'p50_ms': percentile(delays, 0.50) * 1000,
+            'p95_ms': percentile(delays, 0.95) * 1000,
+            'p99_ms': percentile(delays, 0.99) * 1000,
+            'rps': 0,
+        }
+        watchers.close()
+    return results
+
+
+def start_server(args, db_path, image_dir, workdir):
+    env = dict(os.environ, MESSAGE_BOARD_DB=db_path, IMAGE_STORE_DIR=image_dir)
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'serve.py'), '--workers', str(args.server_workers),
+         '--port', str(args.port), '--async-mode', server_async_mode(),
+         '--queue', f"sqlite:///{os.path.join(workdir, 'queue.db')}"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ports = [args.port + number for number in range(args.server_workers)]
+    for port in ports:
+        wait_for_port(port)
+    return server, [f'http://127.0.0.1:{port}' for port in ports]
+
+
+def compare(results, baseline, tolerance):
+    """Print changes against ``baseline`` and return the regressed scenarios."""
+    regressions = []
+    print(f"\n{'scenario':<16} {'p95 ms':>9} {'base':>9} {'change':>8} "
+          f"{'req/s':>9} {'base':>9} {'change':>8}")
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        p95_change = result['p95_ms'] / base['p95_ms'] - 1 if base['p95_ms'] else 0
+        rps_change = result['rps'] / base['rps'] - 1 if base['rps'] else 0
+        regressed = p95_change > tolerance or rps_change < -tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<16} {result['p95_ms']:>9.1f} {base['p95_ms']:>9.1f} {p95_change:>+8.0%} "
+              f"{result['rps']:>9.0f} {base['rps']:>9.0f} {rps_change:>+8.0%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('client', 'http'), default='client')
+    parser.add_argument('--db', help='seed this database and keep it (default: a temporary one)')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--comments', type=int, default=3, help='comments per message')
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--image-every', type=int, default=10,
+                        help='give every Nth message an image (0 for none)')
+    parser.add_argument('--image-size', type=int, default=512, help='image width and height')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--sockets', type=int, default=20, help='Socket.IO clients in http mode')
+    parser.add_argument('--url', nargs='+', help='load-test running servers instead of serve.py')
+    parser.add_argument('--server-workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=5700)
+    parser.add_argument('--save', help='write the results to this baseline file')
+    parser.add_argument('--compare', help='compare against this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional slowdown before a comparison fails')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    if args.db:
+        db_path = os.path.abspath(args.db)
+        image_dir = os.path.join(os.path.dirname(db_path), 'image_store')
+    else:
+        db_path = temp_db_path('loadtest')
+        image_dir = os.path.join(workdir, 'images')
+    os.environ['IMAGE_STORE_DIR'] = image_dir
+    os.environ.setdefault('IMAGE_PROVIDER', 'fake')
+    server = None
+    try:
+        app = load_app(db_path)
+        with app.db_pool.connection() as db:
+            existing = db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if existing:
+            # A kept --db is reused as it is, so repeated runs see the same board
+            print(f'Using the existing board in {args.db} ({existing:,} messages)')
+            args.messages = existing
+        else:
+            seed_board(db_path, messages=args.messages, comments_per_message=args.comments,
+                       tags=args.tags, seed=SEED, image_every=args.image_every,
+                       image_size=args.image_size, image_store=app.image_store)
+
+        if args.mode == 'client':
+            results, memory = run_client_mode(args, app)
+        else:
+            urls = args.url
+            if not urls:
+                server, urls = start_server(args, db_path, image_dir, workdir)
+            results = run_http_mode(args, urls)
+            memory = {'server_rss_mb': process_rss_mb(server.pid)} if server else {}
+
+        print(f"{'scenario':<16} {'requests':>9} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'req/s':>8}")
+        for name, result in results.items():
+            print(f"{name:<16} {result['requests']:>9} {result['errors']:>7} "
+                  f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+                  f"{result['rps']:>8.0f}")
+        for name, value in memory.items():
+            print(f'{name}: {value:.0f}')
+
+        config = {key: value for key, value in vars(args).items()
+                  if key not in ('save', 'compare', 'tolerance', 'db', 'url', 'port')}
+        if args.save:
+            with open(args.save, 'w') as out:
+                json.dump({'config': config, 'results': results, 'memory': memory}, out, indent=2)
+            print(f'\nBaseline saved to {args.save}')
+        if args.compare:
+            with open(args.compare) as baseline_file:
+                baseline = json.load(baseline_file)
+            if baseline['config'] != config:
+                print('Warning: baseline was recorded with different settings')
+            regressions = compare(results, baseline, args.tolerance)
+            if regressions:
+                print(f"\nRegressed: {', '.join(regressions)}")
+                sys.exit(1)
+            print('\nNo regressions.')
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+        if not args.db:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.unlink(db_path + suffix)
+
+
+if __name__ == '__main__':
+    main()
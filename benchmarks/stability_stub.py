@@ -0,0 +1,79 @@
+"""Local stand-in for api.stability.ai's text-to-image endpoint.
+
+    python benchmarks/stability_stub.py --port 8765 --delay 2
+    STABILITY_API_HOST=http://127.0.0.1:8765 STABILITY_API_KEY=stub python app.py
+
+Every request gets a solid-colour PNG derived from the prompt after ``--delay``
+seconds, so the job queue, coalescing and cache can be exercised offline.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+def render_png(prompt, width, height):
+    colour = tuple(hashlib.sha256(prompt.encode()).digest()[:3])
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), colour).save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    calls = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        if not self.path.endswith('/text-to-image'):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        with StubHandler.lock:
+            StubHandler.calls += 1
+        time.sleep(self.delay)
+
+        prompt = body['text_prompts'][0]['text']
+        payload = json.dumps({'artifacts': [{
+            'base64': render_png(prompt, min(body.get('width', 64), 256), min(body.get('height', 64), 256)),
+            'finishReason': 'SUCCESS',
+        }]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0, delay=0.0):
+    """Start the stub on a background thread and return the server."""
+    StubHandler.delay = delay
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=1.0)
+    args = parser.parse_args()
+    server = serve(args.port, args.delay)
+    print(f'Stability stub on http://127.0.0.1:{server.server_port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
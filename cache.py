@@ -0,0 +1,192 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe LRU map bounded by the total size of its values in bytes.
+
+    ``on_evict`` is called with each key pushed out to make room, while the
+    cache's lock is held.
+    """
+
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=None):
+        """Store ``value``; returns False if it is too big to cache at all."""
+        size = len(value) if size is None else size
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(evicted_key)
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+            }
+
+
+def _discard(index, name, key):
+    keys = index.get(name)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del index[name]
+
+
+class RenderCache:
+    """Rendered feed pages and per-message HTML fragments.
+
+    Each page remembers which messages it shows, and the first page of each
+    feed is tracked by feed name. Changing a message drops its fragment and
+    every page showing it; a new post drops only the first page of the feeds
+    it lands in, because keyset pages further down never gain new rows.
+
+    Renders that started before an invalidation are not stored, so a slow
+    render can't put stale HTML back after the write that changed it.
+    Fragment keys start with the message id and include whatever state the
+    card shows, so a card changed by another worker is never served even
+    before that worker's invalidation arrives.
+
+    The indexes only hold keys of pages and fragments still in the caches;
+    evicting or dropping one removes it from them too, so they stay as
+    bounded as the caches are.
+    """
+
+    def __init__(self, max_bytes):
+        # Evictions only happen inside set_page/set_fragment, which hold
+        # self.lock, so the callbacks can update the indexes directly
+        self.pages = LRUCache(max_bytes // 2, on_evict=self._forget_page)
+        self.fragments = LRUCache(max_bytes // 2, on_evict=self._forget_fragment)
+        self.lock = threading.Lock()
+        self.version = 0
+        self.page_index = {}
+        self.pages_by_message = {}
+        self.first_pages = {}
+        self.fragment_keys = {}
+
+    def get_page(self, key):
+        return self.pages.get(key)
+
+    def set_page(self, key, html, message_ids, feed=None, version=None):
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self._forget_page(key)
+            if not self.pages.set(key, html, len(html.encode())):
+                return
+            message_ids = tuple(message_ids)
+            self.page_index[key] = (message_ids, feed)
+            for message_id in message_ids:
+                self.pages_by_message.setdefault(message_id, set()).add(key)
+            if feed is not None:
+                self.first_pages.setdefault(feed, set()).add(key)
+
+    def _forget_page(self, key):
+        entry = self.page_index.pop(key, None)
+        if entry is None:
+            return
+        message_ids, feed = entry
+        for message_id in message_ids:
+            _discard(self.pages_by_message, message_id, key)
+        if feed is not None:
+            _discard(self.first_pages, feed, key)
+
+    def _drop_page(self, key):
+        self.pages.delete(key)
+        self._forget_page(key)
+
+    def _forget_fragment(self, key):
+        if self.fragment_keys.get(key[0]) == key:
+            del self.fragment_keys[key[0]]
+
+    def get_fragment(self, key):
+        return self.fragments.get(key)
+
+    def set_fragment(self, key, html, version=None):
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            # One card per message: an older state's card is dropped right away
+            old_key = self.fragment_keys.get(key[0])
+            if old_key is not None and old_key != key:
+                self.fragments.delete(old_key)
+            self.fragment_keys[key[0]] = key
+            self.fragments.set(key, html, len(html.encode()))
+
+    def invalidate_messages(self, message_ids):
+        with self.lock:
+            self.version += 1
+            for message_id in message_ids:
+                key = self.fragment_keys.pop(message_id, None)
+                if key is not None:
+                    self.fragments.delete(key)
+                for key in list(self.pages_by_message.get(message_id, ())):
+                    self._drop_page(key)
+
+    def invalidate_feeds(self, feeds):
+        with self.lock:
+            self.version += 1
+            for feed in feeds:
+                for key in list(self.first_pages.get(feed, ())):
+                    self._drop_page(key)
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.pages.clear()
+            self.fragments.clear()
+            self.page_index.clear()
+            self.pages_by_message.clear()
+            self.first_pages.clear()
+            self.fragment_keys.clear()
+
+    def stats(self):
+        return {'pages': self.pages.stats(), 'fragments': self.fragments.stats()}
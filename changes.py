@@ -0,0 +1,155 @@
+"""Change log that lets clients catch up on what they missed.
+
+Every new message, new comment and reaction flush appends a row to
+``changes`` in the same transaction as the write, under an ever-increasing
+``seq``. A client that remembers the last seq it saw asks for everything
+after it instead of reloading the page. ``compact_changes`` drops reaction
+updates that a later one for the same message supersedes, and everything
+older than the retention window; a client that was away longer than that
+is told to reload.
+"""
+import json
+import threading
+import time
+import traceback
+
+# Logged by bulk imports and restores, which are too big to replay
+RELOAD = 'reload'
+REPLAY_LIMIT = 500
+
+
+def create_change_log(cursor):
+    # AUTOINCREMENT so a seq is never reused after compaction deletes the tail
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changes
+        (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+         event TEXT NOT NULL,
+         message_id INTEGER,
+         payload TEXT NOT NULL,
+         created_at REAL NOT NULL)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_changes_message
+        ON changes (message_id, event, seq)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_changes_created_at
+        ON changes (created_at)
+    ''')
+    # Highest seq removed by age; older cursors can't be replayed
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changes_compacted
+        (id INTEGER PRIMARY KEY CHECK (id = 1),
+         seq INTEGER NOT NULL)
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO changes_compacted (id, seq) VALUES (1, 0)")
+
+
+def record_change(cursor, event, payload, message_id=None):
+    """Append a change inside the caller's transaction; returns payload plus its seq."""
+    cursor.execute('''
+        INSERT INTO changes (event, message_id, payload, created_at)
+        VALUES (?, ?, ?, ?)
+        RETURNING seq
+    ''', (event, message_id, json.dumps(payload), time.time()))
+    return dict(payload, seq=cursor.fetchone()[0])
+
+
+def latest_seq(cursor):
+    # sqlite_sequence keeps the highest seq handed out, even once compacted away
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def changes_since(cursor, since, limit=REPLAY_LIMIT):
+    """Return up to ``limit`` changes after ``since``, oldest first.
+
+    The result is ``{'changes': [{'seq', 'event', 'data'}], 'last_seq',
+    'more', 'reload'}``; ask again from ``last_seq`` while ``more`` is set.
+    ``reload`` means the gap can't be replayed and the page should be
+    fetched again.
+    """
+    latest = latest_seq(cursor)
+    cursor.execute("SELECT seq FROM changes_compacted WHERE id = 1")
+    compacted = cursor.fetchone()[0]
+    # A seq from the future means the board was replaced under the client
+    if since < compacted or since > latest:
+        return {'changes': [], 'last_seq': latest, 'more': False, 'reload': True}
+
+    cursor.execute('''
+        SELECT seq, event, payload FROM changes
+        WHERE seq > ?
+        ORDER BY seq
+        LIMIT ?
+    ''', (since, limit + 1))
+    rows = cursor.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    changes = []
+    for seq, event, payload in rows:
+        if event == RELOAD:
+            return {'changes': [], 'last_seq': latest, 'more': False, 'reload': True}
+        changes.append({'seq': seq, 'event': event, 'data': dict(json.loads(payload), seq=seq)})
+    if more:
+        last_seq = rows[-1][0]
+    else:
+        # Rows committed after latest was read are in the result too
+        last_seq = max(latest, rows[-1][0]) if rows else latest
+    return {'changes': changes, 'last_seq': last_seq, 'more': more, 'reload': False}
+
+
+def compact_changes(db, max_age, now=None):
+    """Drop superseded reaction updates and changes older than ``max_age`` seconds.
+
+    Returns ``(superseded, expired)`` row counts.
+    """
+    now = time.time() if now is None else now
+    with db:
+        cursor = db.cursor()
+        # A reaction update carries the message's full totals, so only the
+        # newest one per message matters to anyone replaying past it
+        cursor.execute('''
+            DELETE FROM changes
+            WHERE event = 'reaction_update'
+              AND seq < (SELECT MAX(newer.seq) FROM changes AS newer
+                         WHERE newer.message_id = changes.message_id
+                           AND newer.event = 'reaction_update')
+        ''')
+        superseded = max(cursor.rowcount, 0)
+        cursor.execute("SELECT MAX(seq) FROM changes WHERE created_at < ?", (now - max_age,))
+        cutoff = cursor.fetchone()[0]
+        expired = 0
+        if cutoff is not None:
+            cursor.execute("DELETE FROM changes WHERE seq <= ?", (cutoff,))
+            expired = max(cursor.rowcount, 0)
+            cursor.execute("UPDATE changes_compacted SET seq = MAX(seq, ?) WHERE id = 1", (cutoff,))
+    return superseded, expired
+
+
+class ChangeLogCompactor:
+    """Background thread that runs ``compact_changes`` every ``interval`` seconds."""
+
+    def __init__(self, db_pool, max_age, interval=300):
+        self.db_pool = db_pool
+        self.max_age = max_age
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='change-log-compact', daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.db_pool.connection() as db:
+                    compact_changes(db, self.max_age)
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        self.stopped.set()
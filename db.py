@@ -0,0 +1,209 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from aggregates import create_aggregates, create_comment_counts
+from changes import create_change_log
+from search import create_search_index, strip_highlight_markers
+from versions import create_feed_versions
+
+BUSY_TIMEOUT_MS = 5000
+
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+    ('cache_size', -64000),        # KiB, so about 64 MB of page cache
+    ('mmap_size', 268435456),      # 256 MB
+    ('temp_store', 'MEMORY'),
+)
+
+
+def connect(path, factory=sqlite3.Connection):
+    # Connections are handed between threads by the pool, but only ever used
+    # by one thread at a time
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                         factory=factory)
+    for name, value in PRAGMAS:
+        db.execute(f'PRAGMA {name} = {value}')
+    return db
+
+
+class ConnectionPool:
+    """Reusable, pre-tuned SQLite connections.
+
+    A thread checks out a connection, has it to itself until it gives it
+    back, and the next request or worker reuses it instead of paying for a
+    new connect plus PRAGMA setup.
+    """
+
+    def __init__(self, path, max_idle=8, factory=sqlite3.Connection):
+        self.path = path
+        self.max_idle = max_idle
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return connect(self.path, self.factory)
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(db)
+                return
+        db.close()
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for db in idle:
+            db.close()
+
+
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {column[1] for column in cursor.fetchall()}
+
+
+def _base_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         content TEXT NOT NULL,
+         image_data TEXT,
+         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS comments
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         message_id INTEGER,
+         content TEXT NOT NULL,
+         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+         FOREIGN KEY (message_id) REFERENCES messages (id))
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tags
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         name TEXT UNIQUE NOT NULL)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_tags
+        (message_id INTEGER,
+         tag_id INTEGER,
+         FOREIGN KEY (message_id) REFERENCES messages (id),
+         FOREIGN KEY (tag_id) REFERENCES tags (id),
+         PRIMARY KEY (message_id, tag_id))
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reactions
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         message_id INTEGER,
+         reaction TEXT,
+         count INTEGER DEFAULT 0,
+         FOREIGN KEY (message_id) REFERENCES messages (id),
+         UNIQUE(message_id, reaction))
+    ''')
+
+
+def _image_store(cursor):
+    if 'image_hash' not in _columns(cursor, 'messages'):
+        cursor.execute("ALTER TABLE messages ADD COLUMN image_hash TEXT")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_cache
+        (key TEXT PRIMARY KEY,
+         image_hash TEXT NOT NULL,
+         last_used REAL NOT NULL)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_image_cache_last_used
+        ON image_cache (last_used)
+    ''')
+
+
+def _feed_indexes(cursor):
+    # Keyset pagination walks this index newest-first
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_timestamp_id
+        ON messages (timestamp, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_comments_message_timestamp
+        ON comments (message_id, timestamp, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_tags_tag
+        ON message_tags (tag_id, message_id)
+    ''')
+
+
+def _tag_timestamps(cursor):
+    # A copy of the message's timestamp on each tag link lets a tag page
+    # walk one index range newest-first, like the main feed, instead of
+    # sorting every message with the tag
+    if 'timestamp' not in _columns(cursor, 'message_tags'):
+        cursor.execute("ALTER TABLE message_tags ADD COLUMN timestamp DATETIME")
+    cursor.execute('''
+        UPDATE message_tags
+        SET timestamp = (SELECT timestamp FROM messages WHERE id = message_tags.message_id)
+        WHERE timestamp IS NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_tags_tag_timestamp
+        ON message_tags (tag_id, timestamp, message_id)
+    ''')
+    # Writers set it themselves; this covers any that don't
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_tags_timestamp
+        AFTER INSERT ON message_tags
+        WHEN NEW.timestamp IS NULL
+        BEGIN
+            UPDATE message_tags
+            SET timestamp = (SELECT timestamp FROM messages WHERE id = NEW.message_id)
+            WHERE message_id = NEW.message_id AND tag_id = NEW.tag_id;
+        END
+    ''')
+
+
+# Append only: a database at version N has run the first N migrations.
+# Steps use IF NOT EXISTS so boards created before versioning upgrade cleanly.
+MIGRATIONS = [
+    _base_schema,
+    _image_store,
+    _feed_indexes,
+    create_aggregates,
+    create_search_index,
+    create_feed_versions,
+    create_change_log,
+    create_comment_counts,
+    _tag_timestamps,
+    strip_highlight_markers,
+]
+
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db):
+    """Bring the schema up to date and return the resulting version."""
+    version = schema_version(db)
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        cursor = db.cursor()
+        step(cursor)
+        cursor.execute(f"PRAGMA user_version = {number}")
+        db.commit()
+    return len(MIGRATIONS)
@@ -0,0 +1,137 @@
+"""Streaming NDJSON export of the board.
+
+Records use the same shape ``posts.import_jsonl`` reads, so an export can be
+restored with ``preserve_ids``. Messages come first, then comments, then one
+``checkpoint`` record holding the highest ids written; passing those back as
+``since_message_id``/``since_comment_id`` exports only what was added since.
+Reactions are a snapshot taken with each exported message.
+"""
+import json
+import os
+import shutil
+
+from feed import load_tags
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FILENAME = 'board.ndjson'
+IMAGES_DIRNAME = 'images'
+
+
+def export_records(db, since_message_id=0, since_comment_id=0, since_timestamp=None,
+                   batch_size=EXPORT_BATCH_SIZE):
+    """Yield export records, reading ``batch_size`` rows at a time by id.
+
+    Every scan runs in one read transaction, so they all see the same
+    snapshot: a comment posted during the export can't be written without
+    its message and then be skipped by the next incremental export.
+    """
+    cursor = db.cursor()
+    cursor.execute("BEGIN")
+    try:
+        yield from _scan_records(cursor, since_message_id, since_comment_id, since_timestamp,
+                                 batch_size)
+    finally:
+        db.commit()
+
+
+def _scan_records(cursor, since_message_id, since_comment_id, since_timestamp, batch_size):
+    timestamp_filter = 'AND timestamp > ?' if since_timestamp else ''
+    timestamp_params = (since_timestamp,) if since_timestamp else ()
+
+    last_message_id = since_message_id
+    while True:
+        cursor.execute(f'''
+            SELECT id, content, image_hash, timestamp, reaction_counts
+            FROM messages
+            WHERE id > ? {timestamp_filter}
+            ORDER BY id
+            LIMIT ?
+        ''', (last_message_id, *timestamp_params, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        tags = load_tags(cursor, [row[0] for row in rows])
+        for message_id, content, image_hash, timestamp, reaction_counts in rows:
+            yield {
+                'type': 'message',
+                'id': message_id,
+                'content': content,
+                'image_hash': image_hash,
+                'timestamp': timestamp,
+                'tags': tags.get(message_id, []),
+                'reactions': json.loads(reaction_counts),
+            }
+        last_message_id = rows[-1][0]
+
+    last_comment_id = since_comment_id
+    while True:
+        cursor.execute(f'''
+            SELECT id, message_id, content, timestamp
+            FROM comments
+            WHERE id > ? {timestamp_filter}
+            ORDER BY id
+            LIMIT ?
+        ''', (last_comment_id, *timestamp_params, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for comment_id, message_id, content, timestamp in rows:
+            yield {
+                'type': 'comment',
+                'id': comment_id,
+                'message_id': message_id,
+                'content': content,
+                'timestamp': timestamp,
+            }
+        last_comment_id = rows[-1][0]
+
+    yield {'type': 'checkpoint', 'message_id': last_message_id, 'comment_id': last_comment_id}
+
+
+def export_ndjson(db, **since):
+    """Yield the export as NDJSON lines."""
+    for record in export_records(db, **since):
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def export_to_directory(db, store, directory, **since):
+    """Write ``board.ndjson`` plus one file per referenced image into ``directory``.
+
+    Image files that are already there (from an earlier export) are skipped.
+    Returns the checkpoint record.
+    """
+    images_dir = os.path.join(directory, IMAGES_DIRNAME)
+    os.makedirs(images_dir, exist_ok=True)
+    checkpoint = None
+    with open(os.path.join(directory, EXPORT_FILENAME), 'w', encoding='utf-8') as out:
+        for record in export_records(db, **since):
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            image_hash = record.get('image_hash')
+            if image_hash and store.exists(image_hash):
+                target = os.path.join(images_dir, f'{image_hash}.webp')
+                if not os.path.exists(target):
+                    shutil.copyfile(store.path(image_hash), target)
+            if record['type'] == 'checkpoint':
+                checkpoint = record
+    return checkpoint
+
+
+def restore_images(store, directory):
+    """Put exported image files back into the store; returns how many were added."""
+    images_dir = os.path.join(directory, IMAGES_DIRNAME)
+    if not os.path.isdir(images_dir):
+        return 0
+    restored = 0
+    for entry in os.scandir(images_dir):
+        digest, extension = os.path.splitext(entry.name)
+        if extension == '.webp' and not store.exists(digest):
+            with open(entry.path, 'rb') as image_file:
+                store.restore(digest, image_file.read())
+            restored += 1
+    return restored
+
+
+def read_export(directory):
+    """Yield the lines of an export directory's NDJSON file without loading it."""
+    with open(os.path.join(directory, EXPORT_FILENAME), encoding='utf-8') as export_file:
+        yield from export_file
@@ -0,0 +1,230 @@
+import base64
+import json
+from collections import defaultdict, namedtuple
+
+from flask import url_for
+
+# Same shape the template has always indexed into:
+# message[0] id ... message[6] reactions, then comment_count. comments holds
+# only the latest COMMENT_PREVIEW as (content, timestamp, id), oldest first.
+FeedMessage = namedtuple('FeedMessage', [
+    'id', 'content', 'image_hash', 'timestamp', 'comments', 'tags', 'reactions',
+    'comment_count'
+])
+
+# SQLite's default SQLITE_MAX_VARIABLE_NUMBER is 999 on older builds
+MAX_IN_PARAMS = 900
+
+
+def _chunks(ids, size=MAX_IN_PARAMS):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def _placeholders(ids):
+    return ','.join('?' * len(ids))
+
+
+# Comments shown on each feed card; the rest load on demand
+COMMENT_PREVIEW = 3
+COMMENT_PAGE_SIZE = 50
+
+
+def load_comments(cursor, message_ids, limit=COMMENT_PREVIEW):
+    """Latest ``limit`` comments of each message, oldest first."""
+    comments = defaultdict(list)
+    for chunk in _chunks(message_ids):
+        # Top-N per message: each subquery walks idx_comments_message_timestamp
+        # backwards and stops after ``limit`` entries. A ROW_NUMBER() window
+        # would number every comment of the thread first.
+        cursor.execute(f'''
+            SELECT comments.message_id, comments.content, comments.timestamp, comments.id
+            FROM messages
+            JOIN comments ON comments.id IN (SELECT latest.id FROM comments AS latest
+                                             WHERE latest.message_id = messages.id
+                                             ORDER BY latest.timestamp DESC, latest.id DESC
+                                             LIMIT ?)
+            WHERE messages.id IN ({_placeholders(chunk)})
+            ORDER BY comments.message_id, comments.timestamp ASC, comments.id ASC
+        ''', [limit] + chunk)
+        for message_id, content, timestamp, comment_id in cursor.fetchall():
+            comments[message_id].append((content, timestamp, comment_id))
+    return comments
+
+
+def fetch_comment_page(cursor, message_id, before=None, limit=COMMENT_PAGE_SIZE):
+    """One page of a message's comments older than the ``before`` cursor.
+
+    Without a cursor the page ends at the newest comment. Returns the
+    comments oldest first and the cursor for the page before (None at the
+    first comment).
+    """
+    params = [message_id]
+    sql = '''
+        SELECT content, timestamp, id FROM comments
+        WHERE message_id = ?
+    '''
+    if before is not None:
+        sql += ' AND (timestamp, id) < (?, ?)'
+        params.extend(decode_cursor(before))
+    sql += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    next_cursor = comment_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit][::-1], next_cursor
+
+
+def load_tags(cursor, message_ids):
+    tags = defaultdict(list)
+    for chunk in _chunks(message_ids):
+        cursor.execute(f'''
+            SELECT message_tags.message_id, tags.name
+            FROM message_tags
+            JOIN tags ON tags.id = message_tags.tag_id
+            WHERE message_tags.message_id IN ({_placeholders(chunk)})
+        ''', chunk)
+        for message_id, name in cursor.fetchall():
+            tags[message_id].append(name)
+    return tags
+
+
+def assemble_feed(cursor, message_rows):
+    """Build feed messages from (id, content, image_hash, timestamp, reaction_counts,
+    comment_count) rows.
+
+    Attaches the latest comments and the tags with two set-based queries per
+    chunk of message ids instead of queries per message, and keeps the order
+    of ``message_rows``. Reactions and comment counts come from denormalized
+    columns.
+    """
+    message_ids = [row[0] for row in message_rows]
+    if not message_ids:
+        return []
+
+    comments = load_comments(cursor, message_ids)
+    tags = load_tags(cursor, message_ids)
+
+    return [
+        FeedMessage(*row[:4],
+                    comments=comments.get(row[0], []),
+                    tags=tags.get(row[0], []),
+                    reactions=json.loads(row[4]),
+                    comment_count=row[5])
+        for row in message_rows
+    ]
+
+
+PAGE_SIZE = 20
+
+# The row shape assemble_feed expects
+MESSAGE_COLUMNS = '''messages.id, messages.content, messages.image_hash, messages.timestamp,
+                   messages.reaction_counts, messages.comment_count'''
+
+
+def _encode_key(timestamp, row_id):
+    raw = f'{timestamp}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def encode_cursor(message):
+    return _encode_key(message[3], message[0])
+
+
+def comment_cursor(comment):
+    """Cursor for the comments before a ``(content, timestamp, id)`` comment."""
+    return _encode_key(comment[1], comment[2])
+
+
+def decode_cursor(token):
+    """Return (timestamp, id) from a cursor token, or raise ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        timestamp, message_id = raw.rsplit('|', 1)
+        return timestamp, int(message_id)
+    except ValueError as e:
+        raise ValueError(f'Invalid cursor: {token!r}') from e
+
+
+def fetch_feed_page(cursor, tag_name=None, after=None, limit=PAGE_SIZE):
+    """Load one page of the feed, newest first, keyed on (timestamp, id).
+
+    ``after`` is a cursor token from a previous page. Returns the assembled
+    messages and the token for the next page (None on the last page). Each
+    page is an index range scan, so page 500 costs the same as page 1.
+    """
+    params = []
+    where = []
+    if tag_name is None:
+        # Tag pages walk message_tags' copy of (timestamp, id) instead
+        key = 'messages.timestamp', 'messages.id'
+        sql = f'''
+            SELECT {MESSAGE_COLUMNS}
+            FROM messages
+        '''
+    else:
+        cursor.execute("SELECT id FROM tags WHERE name = ?", (tag_name,))
+        tag = cursor.fetchone()
+        if tag is None:
+            return [], None
+        key = 'message_tags.timestamp', 'message_tags.message_id'
+        sql = f'''
+            SELECT {MESSAGE_COLUMNS}
+            FROM message_tags
+            JOIN messages ON messages.id = message_tags.message_id
+        '''
+        where.append('message_tags.tag_id = ?')
+        params.append(tag[0])
+
+    if after is not None:
+        where.append(f'({key[0]}, {key[1]}) < (?, ?)')
+        params.extend(decode_cursor(after))
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY {key[0]} DESC, {key[1]} DESC LIMIT ?'
+    # One extra row tells us whether there is a next page
+    params.append(limit + 1)
+
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return assemble_feed(cursor, rows[:limit]), next_cursor
+
+
+def fetch_messages(cursor, message_ids):
+    """Assemble the given messages, in the order of ``message_ids``."""
+    rows = {}
+    for chunk in _chunks(list(message_ids)):
+        cursor.execute(f'''
+            SELECT {MESSAGE_COLUMNS}
+            FROM messages
+            WHERE messages.id IN ({_placeholders(chunk)})
+        ''', chunk)
+        rows.update((row[0], row) for row in cursor.fetchall())
+    return assemble_feed(cursor, [rows[message_id] for message_id in message_ids
+                                  if message_id in rows])
+
+
+def image_url(image_hash, variant='full'):
+    if not image_hash:
+        return None
+    return url_for('image', digest=image_hash, variant=variant)
+
+
+def message_to_dict(message):
+    return {
+        'id': message.id,
+        'content': message.content,
+        'image_url': image_url(message.image_hash),
+        'thumbnail_url': image_url(message.image_hash, 'thumb'),
+        'timestamp': message.timestamp,
+        'comments': [comment_to_dict(comment) for comment in message.comments],
+        'comment_count': message.comment_count,
+        'tags': message.tags,
+        'reactions': message.reactions,
+    }
+
+
+def comment_to_dict(comment):
+    content, timestamp, comment_id = comment
+    return {'id': comment_id, 'content': content, 'timestamp': timestamp}
@@ -0,0 +1,269 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+IMAGE_FORMAT = 'WEBP'
+IMAGE_MIMETYPE = 'image/webp'
+FULL_QUALITY = 85
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_SIZE = (640, 640)
+THUMBNAIL_MAX_BYTES = 100 * 1024
+
+# Defaults for ImageStore's limits
+MAX_DIMENSIONS = (2048, 2048)
+MAX_BYTES = 500 * 1024
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+# Checked from the header, before any pixels are decoded
+MAX_PIXELS = 50_000_000
+# Quality reductions tried, by bisection, before an image is scaled down
+QUALITY_STEPS = (0, 10, 20, 30, 40)
+MIN_DIMENSION = 256
+
+VARIANTS = ('full', 'thumb')
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+class ImageTooLarge(InvalidImage):
+    pass
+
+
+def _webp(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, IMAGE_FORMAT, quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def _encode_within(image, quality, max_bytes):
+    """WebP-encode ``image``, lowering quality and then size until it fits."""
+    qualities = [quality - step for step in QUALITY_STEPS]
+    while True:
+        data = _webp(image, qualities[0])
+        if len(data) <= max_bytes:
+            return data
+        lowest = _webp(image, qualities[-1])
+        if len(lowest) <= max_bytes:
+            # Bisect for the best quality that fits; lowest is known to
+            best, low, high = lowest, 1, len(qualities) - 2
+            while low <= high:
+                middle = (low + high) // 2
+                data = _webp(image, qualities[middle])
+                if len(data) <= max_bytes:
+                    best, high = data, middle - 1
+                else:
+                    low = middle + 1
+            return best
+        if max(image.size) <= MIN_DIMENSION:
+            raise ImageTooLarge(f'Image does not fit in {max_bytes} bytes')
+        # Bytes grow with area, so scale by the root of how far over it is
+        scale = min(0.9, (max_bytes / len(lowest)) ** 0.5)
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))),
+                             Image.LANCZOS)
+
+
+def encode_image(raw, max_dimensions=MAX_DIMENSIONS, max_bytes=MAX_BYTES):
+    """Decode an upload and return ``(full, thumbnail)`` WebP bytes.
+
+    The image is rotated upright from its EXIF orientation, scaled down to
+    ``max_dimensions`` and re-encoded at ``FULL_QUALITY``, or lower until
+    it fits ``max_bytes``. Runs in ``EncoderPool``'s processes, so it only
+    takes and returns plain values.
+    """
+    try:
+        image = Image.open(io.BytesIO(raw))
+        if image.width * image.height > MAX_PIXELS:
+            raise ImageTooLarge(f'Image is {image.width}x{image.height}, over {MAX_PIXELS} pixels')
+        # JPEGs can decode straight at a fraction of their size
+        image.draft('RGB', max_dimensions)
+        image.load()
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise InvalidImage('Could not decode image') from e
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    image.thumbnail(max_dimensions, Image.LANCZOS)
+    full = _encode_within(image, FULL_QUALITY, max_bytes)
+    image.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+    return full, _encode_within(image, THUMBNAIL_QUALITY, THUMBNAIL_MAX_BYTES)
+
+
+class EncoderPool:
+    """Runs ``encode_image`` in worker processes, off the request threads.
+
+    Decoding and encoding are CPU-bound, so a pool of processes keeps large
+    uploads from stalling every other request behind the GIL. If a worker
+    dies (say, on an image that crashes the decoder), that upload fails and
+    the pool is replaced for the next one.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.executor = self._start()
+
+    def _start(self):
+        executor = ProcessPoolExecutor(max_workers=self.processes)
+        # Fork the workers now, while the process has no other threads
+        # whose locks they could inherit mid-operation
+        executor.submit(int).result()
+        return executor
+
+    def encode(self, raw, max_dimensions, max_bytes):
+        executor = self.executor
+        try:
+            return executor.submit(encode_image, raw, max_dimensions, max_bytes).result()
+        except BrokenProcessPool as e:
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = self._start()
+            raise InvalidImage('Could not decode image') from e
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class ImageStore:
+    """Content-addressed image files on disk.
+
+    Images are keyed by the SHA-256 of the decoded upload, so posting the same
+    picture twice stores it once. Each image is written as a compressed
+    full-size variant, at most ``max_dimensions`` and ``max_bytes``, and a
+    thumbnail under ``root/<digest[:2]>/``. Uploads over
+    ``max_upload_bytes`` are refused before they are decoded. With an
+    ``encoder`` pool, the decoding and encoding run in its processes.
+    """
+
+    def __init__(self, root, max_dimensions=MAX_DIMENSIONS, max_bytes=MAX_BYTES,
+                 max_upload_bytes=MAX_UPLOAD_BYTES, encoder=None):
+        self.root = root
+        self.max_dimensions = tuple(max_dimensions)
+        self.max_bytes = max_bytes
+        self.max_upload_bytes = max_upload_bytes
+        self.encoder = encoder
+
+    def path(self, digest, variant='full'):
+        suffix = '' if variant == 'full' else f'.{variant}'
+        return os.path.join(self.root, digest[:2], f'{digest}{suffix}.webp')
+
+    def exists(self, digest):
+        return bool(DIGEST_RE.match(digest)) and os.path.exists(self.path(digest, 'thumb'))
+
+    def put_base64(self, image_data):
+        if image_data.startswith('data:'):
+            image_data = image_data.split(',', 1)[-1]
+        # Four base64 characters per three bytes: refuse before decoding
+        if len(image_data) // 4 * 3 > self.max_upload_bytes:
+            raise ImageTooLarge(f'Image is larger than {self.max_upload_bytes} bytes')
+        try:
+            raw = base64.b64decode(image_data, validate=True)
+        except binascii.Error as e:
+            raise InvalidImage('Image data is not valid base64') from e
+        return self.put_bytes(raw)
+
+    def put_bytes(self, raw):
+        if len(raw) > self.max_upload_bytes:
+            raise ImageTooLarge(f'Image is larger than {self.max_upload_bytes} bytes')
+        digest = hashlib.sha256(raw).hexdigest()
+        if self.exists(digest):
+            return digest
+
+        if self.encoder is not None:
+            full, thumb = self.encoder.encode(raw, self.max_dimensions, self.max_bytes)
+        else:
+            full, thumb = encode_image(raw, self.max_dimensions, self.max_bytes)
+
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        self._write_bytes(full, self.path(digest, 'full'))
+        # The thumbnail is written last, so exists() only sees complete images
+        self._write_bytes(thumb, self.path(digest, 'thumb'))
+        return digest
+
+    def restore(self, digest, full_bytes):
+        """Reinstate an exported full-size file under its original digest."""
+        if not DIGEST_RE.match(digest):
+            raise InvalidImage(f'Not an image digest: {digest!r}')
+        try:
+            image = Image.open(io.BytesIO(full_bytes))
+            image.load()
+        except (UnidentifiedImageError, OSError) as e:
+            raise InvalidImage('Could not decode image') from e
+
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        full_path = self.path(digest, 'full')
+        tmp_path = f'{full_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as out:
+            out.write(full_bytes)
+        os.replace(tmp_path, full_path)
+        image.thumbnail(THUMBNAIL_SIZE)
+        self._write(image, self.path(digest, 'thumb'), THUMBNAIL_QUALITY)
+
+    def _write(self, image, path, quality):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        image.save(tmp_path, IMAGE_FORMAT, quality=quality, method=4)
+        os.replace(tmp_path, path)
+
+    def _write_bytes(self, data, path):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as out:
+            out.write(data)
+        os.replace(tmp_path, path)
+
+
+def store_from_env(environ=os.environ, encoder=None):
+    """Build the ImageStore configured by ``IMAGE_STORE_DIR``, ``IMAGE_MAX_DIMENSION``,
+    ``IMAGE_MAX_KB`` and ``IMAGE_UPLOAD_MAX_MB``.
+
+    The app and serve.py's startup migration both use it, so legacy images
+    are re-encoded to the same budgets as new uploads.
+    """
+    dimension = int(environ.get('IMAGE_MAX_DIMENSION', MAX_DIMENSIONS[0]))
+    max_kb = int(environ.get('IMAGE_MAX_KB', MAX_BYTES // 1024))
+    upload_mb = int(environ.get('IMAGE_UPLOAD_MAX_MB', MAX_UPLOAD_BYTES // (1024 * 1024)))
+    return ImageStore(environ.get('IMAGE_STORE_DIR', 'image_store'),
+                      max_dimensions=(dimension, dimension), max_bytes=max_kb * 1024,
+                      max_upload_bytes=upload_mb * 1024 * 1024, encoder=encoder)
+
+
+def migrate_inline_images(db, store, batch_size=100):
+    """Move base64 ``messages.image_data`` into the store and set ``image_hash``.
+
+    Safe to re-run: only rows that still have inline data are touched, and rows
+    that fail to decode are left as they are.
+    """
+    cursor = db.cursor()
+    last_id = 0
+    moved = 0
+    while True:
+        cursor.execute('''
+            SELECT id, image_data FROM messages
+            WHERE image_data IS NOT NULL AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return moved
+
+        updates = []
+        for message_id, image_data in rows:
+            try:
+                updates.append((store.put_base64(image_data), message_id))
+            except InvalidImage as e:
+                print(f"Skipping image for message {message_id}: {e}")
+        cursor.executemany(
+            "UPDATE messages SET image_hash = ?, image_data = NULL WHERE id = ?", updates)
+        db.commit()
+        moved += len(updates)
+        last_id = rows[-1][0]
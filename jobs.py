@@ -0,0 +1,179 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from images import InvalidImage
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+
+def cache_key(prompt, params):
+    raw = json.dumps({'prompt': prompt, 'params': params}, sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class GenerationCache:
+    """Persistent LRU map from generation key to image-store hash.
+
+    Lives in its own table of the board database, so cached results survive
+    restarts. Least recently used entries are dropped past ``max_entries``.
+    """
+
+    def __init__(self, db_pool, max_entries=500):
+        self.db_pool = db_pool
+        self.max_entries = max_entries
+
+    @contextmanager
+    def _connect(self):
+        with self.db_pool.connection() as db, db:
+            yield db
+
+    def get(self, key):
+        with self._connect() as db:
+            row = db.execute("SELECT image_hash FROM image_cache WHERE key = ?",
+                             (key,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE image_cache SET last_used = ? WHERE key = ?",
+                           (time.time(), key))
+        return row[0] if row else None
+
+    def put(self, key, image_hash):
+        with self._connect() as db:
+            db.execute('''
+                INSERT INTO image_cache (key, image_hash, last_used) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET image_hash = excluded.image_hash,
+                                               last_used = excluded.last_used
+            ''', (key, image_hash, time.time()))
+            db.execute('''
+                DELETE FROM image_cache WHERE key IN (
+                    SELECT key FROM image_cache
+                    ORDER BY last_used DESC
+                    LIMIT -1 OFFSET ?)
+            ''', (self.max_entries,))
+
+
+class QueueFull(Exception):
+    """Raised by ``ImageJobQueue.submit`` when ``max_pending`` jobs are waiting."""
+
+
+class ImageJob:
+    def __init__(self, prompt, params, key):
+        self.id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.params = params
+        self.key = key
+        self.status = PENDING
+        self.image_hash = None
+        self.error = None
+        self.cached = False
+        # Socket.IO session ids waiting on this job
+        self.sids = set()
+
+
+class ImageJobQueue:
+    """Runs image generation on a bounded thread pool.
+
+    ``generate(prompt, params)`` must return ``(base64_image, error)`` like
+    ``generate_image_with_stability``. Submitting a prompt that is already
+    being generated with the same params joins the running job instead of
+    calling the API again, and finished results are served from ``cache``.
+    ``on_complete(job)`` is called from the worker thread when a job ends.
+
+    At most ``max_pending`` jobs are queued or running; past that, new
+    prompts are refused with ``QueueFull`` rather than waiting behind a
+    backlog the provider can't clear. Cache hits and prompts that join a
+    running job are always accepted.
+    """
+
+    def __init__(self, generate, store, cache, max_workers=2, on_complete=None,
+                 max_finished=1000, max_pending=None):
+        self.generate = generate
+        self.store = store
+        self.cache = cache
+        self.on_complete = on_complete
+        self.max_finished = max_finished
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='image-job')
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.in_flight = {}
+
+    def submit(self, prompt, params, sid=None):
+        key = cache_key(prompt, params)
+
+        with self.lock:
+            job = self.in_flight.get(key)
+            if job is not None:
+                if sid:
+                    job.sids.add(sid)
+                return job
+
+        job = ImageJob(prompt, params, key)
+        image_hash = self.cache.get(key)
+        if image_hash and self.store.exists(image_hash):
+            job.status = DONE
+            job.image_hash = image_hash
+            job.cached = True
+            with self.lock:
+                self._remember(job)
+            return job
+
+        with self.lock:
+            # Another request may have started the same key while we checked the cache
+            running = self.in_flight.get(key)
+            if running is not None:
+                if sid:
+                    running.sids.add(sid)
+                return running
+            if self.max_pending is not None and len(self.in_flight) >= self.max_pending:
+                raise QueueFull(f'{len(self.in_flight)} image jobs already waiting')
+            if sid:
+                job.sids.add(sid)
+            self.in_flight[key] = job
+            self._remember(job)
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _remember(self, job):
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.max_finished:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest.status in (PENDING, RUNNING):
+                break
+            del self.jobs[oldest_id]
+
+    def _run(self, job):
+        job.status = RUNNING
+        try:
+            image_data, error = self.generate(job.prompt, job.params)
+            if error:
+                job.error = error
+            else:
+                job.image_hash = self.store.put_base64(image_data)
+                self.cache.put(job.key, job.image_hash)
+        except InvalidImage as e:
+            job.error = str(e)
+        except Exception as e:
+            job.error = f'Image generation failed: {e}'
+
+        with self.lock:
+            job.status = ERROR if job.error else DONE
+            self.in_flight.pop(job.key, None)
+        if self.on_complete is not None:
+            self.on_complete(job)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,345 @@
+"""Request, SQL and Socket.IO metrics in the Prometheus text format.
+
+Counters, gauges and histograms live in a ``Registry`` that renders them for
+a ``/metrics`` scrape; collectors are called at scrape time for numbers kept
+elsewhere (such as the image provider's latency window). Each worker
+process has its own registry, so scrape every worker.
+
+SQL is measured by ``InstrumentedConnection``, a sqlite3 connection factory
+whose statements are timed per statement kind, added to the current
+request's totals and, over ``slow_query_ms``, written to the slow-query log.
+``SamplingProfiler`` is an optional thread that samples every thread's stack
+at an interval and keeps folded-stack counts for flame graphs.
+"""
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+slow_query_log = logging.getLogger('board.slow_query')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    kind = None
+    initial = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        # An unlabelled series is reported from the start, even at zero
+        if not self.labels and self.initial is not None:
+            self.values[()] = self.initial
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.extend(self._samples(label_values, value))
+        return lines
+
+    def _samples(self, label_values, value):
+        return [f'{self.name}{_format_labels(self.labels, label_values)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+    initial = 0
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    initial = 0
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def _samples(self, label_values, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labels, label_values, [('le', bound)])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labels, label_values, [('le', '+Inf')])
+        lines.append(f'{self.name}_bucket{labels} {count}')
+        labels = _format_labels(self.labels, label_values)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """Register ``collect()``, which returns a list of exposition lines."""
+        self.collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Time from request start to the last byte sent.',
+    ('method', 'route', 'status'))
+request_queries = registry.histogram(
+    'http_request_sql_queries', 'SQL statements run while handling one request.',
+    ('route',), QUERY_COUNT_BUCKETS)
+request_sql_time = registry.histogram(
+    'http_request_sql_seconds', 'Time spent in SQL while handling one request.', ('route',))
+query_duration = registry.histogram(
+    'sql_query_duration_seconds', 'SQL statement execution time.', ('statement',))
+slow_queries = registry.counter(
+    'sql_slow_queries_total', 'Statements slower than the slow-query threshold.')
+socket_clients = registry.gauge(
+    'socketio_connected_clients', 'Socket.IO clients connected to this worker.')
+emit_duration = registry.histogram(
+    'socketio_emit_duration_seconds', 'Time to hand one event to its rooms.', ('event',))
+rate_limited = registry.counter(
+    'http_rate_limited_total', 'Requests rejected with 429 by the rate limiter.', ('endpoint',))
+image_jobs_rejected = registry.counter(
+    'image_jobs_rejected_total', 'Image prompts refused because the job queue was full.')
+
+# Statements slower than this many milliseconds are logged; None turns it off
+slow_query_ms = None
+
+
+def _statement_kind(sql):
+    words = sql.split(None, 1)
+    return words[0].upper() if words else 'EMPTY'
+
+
+def _record_query(sql, elapsed):
+    query_duration.observe(elapsed, _statement_kind(sql))
+    if has_request_context():
+        stats = g.get('_sql_stats')
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+    if slow_query_ms is not None and elapsed * 1000 >= slow_query_ms:
+        slow_queries.inc()
+        where = f' during {request.method} {request.path}' if has_request_context() else ''
+        slow_query_log.warning('%.1f ms%s: %s', elapsed * 1000, where, ' '.join(sql.split()))
+
+
+# SQLite runs a SELECT up to its first row in execute() and the rest as rows
+# are fetched, so large result sets are partly timed by their caller
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_query(sql, time.perf_counter() - started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection factory that times every statement it runs."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def init_metrics(app, slow_ms=None):
+    """Time every request and count its SQL; adds the ``/metrics`` route.
+
+    ``slow_ms`` turns on the slow-query log for statements at least that slow.
+    """
+    global slow_query_ms
+    slow_query_ms = slow_ms
+
+    @app.before_request
+    def start_request_timer():
+        g._request_started = time.perf_counter()
+        g._sql_stats = [0, 0.0]
+
+    @app.after_request
+    def remember_status(response):
+        g._response_status = response.status_code
+        return response
+
+    # Teardown runs after a streamed body has been sent, so streamed pages
+    # are timed to their last byte
+    @app.teardown_request
+    def observe_request(exception):
+        started = g.pop('_request_started', None)
+        if started is None:
+            return
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        status = g.pop('_response_status', 500)
+        request_duration.observe(time.perf_counter() - started, request.method, route, status)
+        queries, sql_time = g.pop('_sql_stats')
+        request_queries.observe(queries, route)
+        request_sql_time.observe(sql_time, route)
+
+    @app.route('/metrics')
+    def metrics():
+        return app.response_class(registry.render(), content_type=CONTENT_TYPE)
+
+
+def provider_collector(name, provider_metrics):
+    """Expose a ``providers.ProviderMetrics`` window as a summary."""
+
+    def collect():
+        snapshot = provider_metrics.snapshot()
+        lines = [f'# HELP {name}_latency_seconds Image provider call latency over recent calls.',
+                 f'# TYPE {name}_latency_seconds summary']
+        for quantile, key in (('0.5', 'latency_p50'), ('0.95', 'latency_p95'), ('1', 'latency_max')):
+            if snapshot[key] is not None:
+                lines.append(f'{name}_latency_seconds{{quantile="{quantile}"}} {snapshot[key]}')
+        lines.append(f'{name}_latency_seconds_count {snapshot["calls"]}')
+        for field in ('errors', 'retries'):
+            lines.append(f'# TYPE {name}_{field}_total counter')
+            lines.append(f'{name}_{field}_total {snapshot[field]}')
+        return lines
+
+    return collect
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread each ``interval`` seconds.
+
+    Stacks are kept as folded-stack counts (``a;b;c 42``), the input format
+    of flamegraph.pl and speedscope. Sampling costs one pass over the
+    threads' frames per tick, so intervals of 10 ms or more are cheap enough
+    to leave on in production.
+    """
+
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            folded = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    code = frame.f_code
+                    names.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                folded.append(';'.join(reversed(names)))
+            with self.lock:
+                self.stacks.update(folded)
+                self.samples += 1
+
+    def folded(self, reset=False):
+        with self.lock:
+            stacks = self.stacks
+            if reset:
+                self.stacks = StackCounter()
+                self.samples = 0
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
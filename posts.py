@@ -0,0 +1,281 @@
+import json
+import threading
+from itertools import islice
+
+from changes import record_change
+from feed import MAX_IN_PARAMS
+from search import clean_text
+
+IMPORT_BATCH_SIZE = 1000
+
+
+def normalize_tags(raw_tags):
+    """Split, trim, lowercase and dedupe tags, keeping first-seen order."""
+    if isinstance(raw_tags, str):
+        raw_tags = raw_tags.split(',')
+    seen = {}
+    for tag in raw_tags:
+        tag = tag.strip().lower()
+        if tag:
+            seen.setdefault(tag, None)
+    return list(seen)
+
+
+class TagResolver:
+    """Maps tag names to ids, creating missing tags, with an in-process cache.
+
+    ``resolve`` runs inside the caller's transaction; ids it had to look up
+    are only added to the cache by ``remember`` once that transaction has
+    committed, so a rollback can't leave ids for tags that don't exist.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = {}
+
+    def resolve(self, cursor, names):
+        with self.lock:
+            found = {name: self.ids[name] for name in names if name in self.ids}
+        missing = [name for name in names if name not in found]
+        for start in range(0, len(missing), MAX_IN_PARAMS):
+            chunk = missing[start:start + MAX_IN_PARAMS]
+            # DO UPDATE (rather than DO NOTHING) makes RETURNING include
+            # existing tags, so new and old ids come back in one statement
+            cursor.execute(f'''
+                INSERT INTO tags (name) VALUES {','.join(['(?)'] * len(chunk))}
+                ON CONFLICT(name) DO UPDATE SET name = excluded.name
+                RETURNING name, id
+            ''', chunk)
+            found.update(cursor.fetchall())
+        return found
+
+    def remember(self, tag_ids):
+        with self.lock:
+            self.ids.update(tag_ids)
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+
+
+def create_message(db, tag_resolver, content, image_hash=None, tags=()):
+    """Insert a message, its tag links and its change log entry in one transaction.
+
+    Returns the new ``(id, content, image_hash, timestamp)`` row, the
+    normalized tag names and the logged ``new_message`` change.
+    """
+    tag_names = normalize_tags(tags)
+    content = clean_text(content)
+    with db:
+        cursor = db.cursor()
+        cursor.execute('''
+            INSERT INTO messages (content, image_hash) VALUES (?, ?)
+            RETURNING id, content, image_hash, timestamp
+        ''', (content, image_hash))
+        message = cursor.fetchone()
+        tag_ids = tag_resolver.resolve(cursor, tag_names)
+        cursor.executemany('''
+            INSERT INTO message_tags (message_id, tag_id, timestamp) VALUES (?, ?, ?)
+        ''', [(message[0], tag_ids[name], message[3]) for name in tag_names])
+        change = record_change(cursor, 'new_message', {
+            'id': message[0],
+            'content': message[1],
+            'image_hash': message[2],
+            'timestamp': message[3],
+            'tags': tag_names,
+        }, message_id=message[0])
+    tag_resolver.remember(tag_ids)
+    return message, tag_names, change
+
+
+def create_comment(db, message_id, content):
+    """Insert a comment and its change log entry; returns the ``new_comment`` change."""
+    content = clean_text(content)
+    with db:
+        cursor = db.cursor()
+        cursor.execute('''
+            INSERT INTO comments (message_id, content) VALUES (?, ?)
+            RETURNING id, timestamp
+        ''', (message_id, content))
+        comment_id, timestamp = cursor.fetchone()
+        return record_change(cursor, 'new_comment', {
+            'id': comment_id,
+            'message_id': message_id,
+            'content': content,
+            'timestamp': timestamp,
+        }, message_id=message_id)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_jsonl(db, tag_resolver, lines, batch_size=IMPORT_BATCH_SIZE, preserve_ids=False):
+    """Bulk-load messages and comments from JSON lines.
+
+    Each line is an object with ``type`` ``message`` (``id``, ``content``,
+    optional ``timestamp``, ``tags``, ``image_hash``, ``reactions``) or
+    ``comment`` (``message_id``, ``content``, optional ``timestamp``). Ids in
+    the file are the source board's; comments are attached to the message
+    imported under that id. Every batch is one transaction of executemany
+    inserts. With ``preserve_ids`` the source ids are kept as-is, which is
+    what restoring an export into an empty board wants. A message whose id
+    is already taken is skipped along with its tags, reactions and
+    comments, so nothing is attached to a different message; comments on
+    ids the file has no message for go to the existing message, as an
+    incremental export's do, and are skipped if there is none.
+
+    Returns counts of imported rows and skipped lines.
+    """
+    counts = {'messages': 0, 'comments': 0, 'tags': 0, 'reactions': 0, 'skipped': 0}
+    id_map = {}
+    for batch in _batches(lines, batch_size):
+        messages, comments = [], []
+        for line in batch:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                kind = record['type']
+                if kind in ('message', 'comment') and not _well_typed(record):
+                    counts['skipped'] += 1
+                elif kind == 'message':
+                    messages.append(record)
+                elif kind == 'comment':
+                    comments.append(record)
+                elif kind != 'checkpoint':
+                    counts['skipped'] += 1
+            except (ValueError, KeyError, TypeError):
+                counts['skipped'] += 1
+
+        tag_ids = _import_batch(db, tag_resolver, messages, comments, id_map, counts,
+                                preserve_ids)
+        tag_resolver.remember(tag_ids)
+    return counts
+
+
+def _well_typed(record):
+    # Fields the batch insert uses as-is; a wrong type would fail the whole
+    # batch or be stored as garbage
+    tags = record.get('tags')
+    reactions = record.get('reactions')
+    return (
+        isinstance(record.get('id'), (int, str, type(None)))
+        and isinstance(record.get('message_id'), (int, str, type(None)))
+        and isinstance(record.get('timestamp'), (str, type(None)))
+        and isinstance(record.get('image_hash'), (str, type(None)))
+        and (tags is None or isinstance(tags, str)
+             or isinstance(tags, list) and all(isinstance(tag, str) for tag in tags))
+        and (reactions is None
+             or isinstance(reactions, dict) and all(type(count) is int and count >= 0
+                                                    for count in reactions.values()))
+    )
+
+
+def _existing_message_ids(cursor, message_ids):
+    message_ids = list(message_ids)
+    found = set()
+    for start in range(0, len(message_ids), MAX_IN_PARAMS):
+        chunk = message_ids[start:start + MAX_IN_PARAMS]
+        cursor.execute(f"SELECT id FROM messages WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        found.update(row[0] for row in cursor.fetchall())
+    return found
+
+
+def _import_batch(db, tag_resolver, messages, comments, id_map, counts, preserve_ids):
+    with db:
+        cursor = db.cursor()
+        # Taking the write lock up front means nobody else can claim ids
+        # between reading max(id) and inserting
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+        next_id = cursor.fetchone()[0] + 1
+
+        taken = set()
+        if preserve_ids:
+            wanted = [record.get('id') for record in messages if isinstance(record.get('id'), int)]
+            taken = _existing_message_ids(cursor, wanted)
+            # Messages without an id must not take one a later record brings
+            next_id = max([next_id, *(message_id + 1 for message_id in wanted)])
+
+        message_rows, link_rows, reaction_rows = [], [], []
+        all_tags = {}
+        for record in messages:
+            if not isinstance(record.get('content'), str):
+                counts['skipped'] += 1
+                continue
+            source_id = record.get('id')
+            if preserve_ids and isinstance(source_id, int):
+                if source_id in taken:
+                    # Already restored, or another message holds the id:
+                    # either way its comments must not be attached to it
+                    id_map[source_id] = None
+                    counts['skipped'] += 1
+                    continue
+                taken.add(source_id)
+                message_id = source_id
+            else:
+                message_id = next_id
+                next_id += 1
+                if source_id is not None:
+                    id_map[source_id] = message_id
+            message_rows.append((message_id, clean_text(record['content']),
+                                 record.get('image_hash'), record.get('timestamp')))
+            tags = normalize_tags(record.get('tags') or [])
+            all_tags.update(dict.fromkeys(tags))
+            link_rows.extend((message_id, tag) for tag in tags)
+            reaction_rows.extend((message_id, reaction, count)
+                                 for reaction, count in (record.get('reactions') or {}).items())
+
+        cursor.executemany('''
+            INSERT INTO messages (id, content, image_hash, timestamp)
+            VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', message_rows)
+        counts['messages'] += len(message_rows)
+        tag_ids = tag_resolver.resolve(cursor, list(all_tags))
+        # The message's stored timestamp, which may have been defaulted
+        cursor.executemany('''
+            INSERT OR IGNORE INTO message_tags (message_id, tag_id, timestamp)
+            SELECT ?, ?, timestamp FROM messages WHERE id = ?
+        ''', [(message_id, tag_ids[tag], message_id) for message_id, tag in link_rows])
+        cursor.executemany('''
+            INSERT INTO reactions (message_id, reaction, count) VALUES (?, ?, ?)
+            ON CONFLICT(message_id, reaction) DO UPDATE SET count = count + excluded.count
+        ''', reaction_rows)
+
+        # A restore may be re-run or overlap an earlier one: comments it
+        # already has are skipped
+        insert = 'INSERT OR IGNORE' if preserve_ids else 'INSERT'
+        existing = set()
+        if preserve_ids:
+            existing = _existing_message_ids(cursor, {
+                record.get('message_id') for record in comments
+                if isinstance(record.get('message_id'), int)} - id_map.keys())
+        comment_rows = []
+        for record in comments:
+            message_id = record.get('message_id')
+            if not preserve_ids or message_id in id_map:
+                message_id = id_map.get(message_id)
+            elif message_id not in existing:
+                message_id = None
+            if message_id is None or not isinstance(record.get('content'), str):
+                counts['skipped'] += 1
+                continue
+            comment_rows.append((record.get('id') if preserve_ids else None, message_id,
+                                 clean_text(record['content']), record.get('timestamp')))
+        cursor.executemany(f'''
+            {insert} INTO comments (id, message_id, content, timestamp)
+            VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', comment_rows)
+        counts['comments'] += max(cursor.rowcount, 0)
+
+    counts['tags'] += len(link_rows)
+    counts['reactions'] += len(reaction_rows)
+    return tag_ids
@@ -0,0 +1,171 @@
+import base64
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ProviderMetrics:
+    """Call, error and latency counters for an image provider."""
+
+    def __init__(self, window=500):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, latency, error=False):
+        with self.lock:
+            self.calls += 1
+            self.errors += int(error)
+            self.latencies.append(latency)
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            calls, errors, retries = self.calls, self.errors, self.retries
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            'calls': calls,
+            'errors': errors,
+            'retries': retries,
+            'latency_p50': percentile(0.50),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+
+class StabilityProvider:
+    """Stability text-to-image client over one pooled, keep-alive session.
+
+    At most ``max_concurrency`` requests are in flight at once. 429s, 5xx
+    responses and connection errors are retried with full-jitter exponential
+    backoff, and a Retry-After header from the server takes precedence.
+    """
+
+    def __init__(self, api_key, host='https://api.stability.ai', connect_timeout=5.0,
+                 read_timeout=120.0, max_concurrency=4, max_retries=3,
+                 backoff=0.5, max_backoff=30.0):
+        self.api_key = api_key
+        self.host = host.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = threading.BoundedSemaphore(max_concurrency)
+        self.metrics = ProviderMetrics()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def generate(self, prompt, params):
+        """Return ``(base64_png, None)`` or ``(None, error_message)``."""
+        if not self.api_key:
+            return None, "Stability API key not set"
+
+        params = dict(params)
+        engine = params.pop('engine')
+        url = f"{self.host}/v1/generation/{engine}/text-to-image"
+        headers = {
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        payload = {"text_prompts": [{"text": prompt}], **params}
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            response = None
+            try:
+                with self.limiter:
+                    response = self.session.post(url, headers=headers, json=payload,
+                                                 timeout=self.timeout)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    image_data = response.json()["artifacts"][0]["base64"]
+                    self.metrics.record(time.perf_counter() - started)
+                    return image_data, None
+                error = f"{response.status_code} from Stability API"
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = str(e)
+            except (requests.exceptions.RequestException, KeyError, IndexError, ValueError) as e:
+                self.metrics.record(time.perf_counter() - started, error=True)
+                return None, str(e)
+
+            self.metrics.record(time.perf_counter() - started, error=True)
+            if attempt >= self.max_retries:
+                return None, error
+            self.metrics.record_retry()
+            time.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+    def _retry_delay(self, attempt, response):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0.0), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class FakeImageProvider:
+    """In-process provider that draws a solid-colour PNG per prompt.
+
+    Stands in for Stability in tests and benchmarks; ``latency`` simulates
+    the time a real generation takes.
+    """
+
+    def __init__(self, latency=0.0, size=(256, 256)):
+        self.latency = latency
+        self.size = size
+        self.metrics = ProviderMetrics()
+
+    def generate(self, prompt, params):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        colour = tuple(hashlib.sha256(prompt.encode()).digest()[:3])
+        buffer = io.BytesIO()
+        Image.new('RGB', self.size, colour).save(buffer, 'PNG')
+        self.metrics.record(time.perf_counter() - started)
+        return base64.b64encode(buffer.getvalue()).decode(), None
+
+
+def provider_from_env():
+    if os.getenv('IMAGE_PROVIDER', 'stability') == 'fake':
+        return FakeImageProvider(latency=float(os.getenv('FAKE_IMAGE_LATENCY', 0)))
+    return StabilityProvider(
+        os.getenv('STABILITY_API_KEY'),
+        host=os.getenv('STABILITY_API_HOST', 'https://api.stability.ai'),
+        connect_timeout=float(os.getenv('STABILITY_CONNECT_TIMEOUT', 5)),
+        read_timeout=float(os.getenv('STABILITY_READ_TIMEOUT', 120)),
+        max_concurrency=int(os.getenv('STABILITY_MAX_CONCURRENCY', 4)),
+        max_retries=int(os.getenv('STABILITY_MAX_RETRIES', 3)),
+    )
@@ -0,0 +1,130 @@
+"""Message queue backends for running the board as several worker processes.
+
+Socket.IO events emitted in one worker reach clients connected to any other
+through a python-socketio pub/sub client manager. ``SQLiteManager`` is a
+stand-in backend for one machine and for testing: workers share a queue
+table in a SQLite file and poll it. Redis, Kafka, ZeroMQ and Kombu URLs use
+the python-socketio managers (and need their client libraries installed).
+
+Render-cache invalidations travel over the same queue as a reserved event
+that the manager intercepts before it reaches any client, so every worker
+drops stale fragments and pages, whichever backend is in use.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+import socketio
+
+CHANNEL = 'flask-socketio'
+CACHE_EVENT = '_cache_invalidate'
+POLL_INTERVAL = 0.02
+RETENTION_SECONDS = 60
+
+
+class SQLiteManager(socketio.PubSubManager):
+    """Pub/sub over a table in a SQLite file, for workers on one machine.
+
+    ``url`` follows the SQLAlchemy form: ``sqlite:///relative/path.db`` or
+    ``sqlite:////absolute/path.db``. Listeners poll for rows newer than the
+    last one they saw; rows older than ``retention`` seconds are pruned.
+    """
+    name = 'sqlite'
+
+    def __init__(self, url='sqlite:///message_queue.db', channel=CHANNEL, write_only=False,
+                 logger=None, json=None, poll_interval=POLL_INTERVAL,
+                 retention=RETENTION_SECONDS):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = url[len('sqlite:///'):]
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.db = self._connect()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS pubsub_messages
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+             channel TEXT NOT NULL,
+             payload TEXT NOT NULL,
+             created REAL NOT NULL)
+        ''')
+        db.commit()
+        return db
+
+    def _publish(self, data):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO pubsub_messages (channel, payload, created) VALUES (?, ?, ?)",
+                (self.channel, json.dumps(data), time.time()))
+
+    def _listen(self):
+        db = self._connect()
+        # Only messages published after this worker started are delivered
+        last_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM pubsub_messages").fetchone()[0]
+        last_pruned = time.monotonic()
+        while True:
+            rows = db.execute('''
+                SELECT id, payload FROM pubsub_messages
+                WHERE id > ? AND channel = ?
+                ORDER BY id
+            ''', (last_id, self.channel)).fetchall()
+            for message_id, payload in rows:
+                last_id = message_id
+                yield json.loads(payload)
+            if time.monotonic() - last_pruned > self.retention:
+                with db:
+                    db.execute("DELETE FROM pubsub_messages WHERE created < ?",
+                               (time.time() - self.retention,))
+                last_pruned = time.monotonic()
+            if not rows:
+                self.server.sleep(self.poll_interval)
+
+
+class CacheEventsMixin:
+    """Turns ``CACHE_EVENT`` emits into ``on_invalidate(payload)`` calls.
+
+    Emits are handled by the sending worker and by every worker that receives
+    them from the queue, so the callback runs once in each process.
+    """
+    on_invalidate = None
+
+    def _handle_emit(self, message):
+        if message.get('event') == CACHE_EVENT:
+            if self.on_invalidate is not None:
+                self.on_invalidate(message['data'][0])
+            return
+        super()._handle_emit(message)
+
+
+def start_listening(server):
+    """Start the queue listener now instead of on the first Socket.IO connect.
+
+    python-socketio only starts it when a client connects, and until then
+    the worker would miss other workers' cache invalidations.
+    """
+    if not server.manager_initialized:
+        server.manager_initialized = True
+        server.manager.initialize()
+
+
+def queue_manager(url, on_invalidate, channel=CHANNEL):
+    """Build the client manager for a message queue URL."""
+    if url.startswith('sqlite://'):
+        base = SQLiteManager
+    elif url.startswith(('redis://', 'rediss://')):
+        base = socketio.RedisManager
+    elif url.startswith('kafka://'):
+        base = socketio.KafkaManager
+    elif url.startswith('zmq'):
+        base = socketio.ZmqManager
+    else:
+        base = socketio.KombuManager
+    manager_class = type(base.__name__, (CacheEventsMixin, base), {})
+    manager = manager_class(url, channel=channel)
+    manager.on_invalidate = on_invalidate
+    return manager
@@ -0,0 +1,157 @@
+"""Token-bucket rate limits per client and route.
+
+Each (route, client) pair has a bucket holding up to ``burst`` tokens that
+refills at ``rate`` tokens a second; a request takes one token or is
+rejected with the time until one is available. Buckets live in a backend:
+``MemoryBackend`` for one process, ``SQLiteBackend`` to share them between
+worker processes on one machine. Anything with the same ``take`` method can
+be plugged in.
+"""
+import math
+import re
+import sqlite3
+import threading
+import time
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600}
+RULE_RE = re.compile(r'^(\d+(?:\.\d+)?)/(second|minute|hour)(?::(\d+))?$')
+
+
+class Rule:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    @classmethod
+    def parse(cls, text):
+        """``'12/minute:5'``: 12 a minute on average, at most 5 at once."""
+        match = RULE_RE.match(text.strip())
+        if match is None:
+            raise ValueError(f'Bad rate limit {text!r}, expected e.g. 12/minute:5')
+        count, period, burst = match.groups()
+        rate = float(count) / PERIODS[period]
+        if rate <= 0:
+            raise ValueError(f'Rate limit {text!r} would reject every request')
+        return cls(rate, int(burst) if burst else max(1, math.ceil(float(count))))
+
+
+def _refill(tokens, updated, rule, now):
+    return min(rule.burst, tokens + (now - updated) * rule.rate)
+
+
+def _take(tokens, rule):
+    """Return ``(tokens_left, retry_after)``; retry_after is 0 when allowed."""
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rule.rate
+
+
+class MemoryBackend:
+    """Buckets in a dict; full buckets are dropped now and then to bound it."""
+
+    def __init__(self, prune_every=10000):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.prune_every = prune_every
+        self.takes = 0
+
+    def take(self, key, rule, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (rule.burst, now, now))
+            tokens, retry_after = _take(_refill(tokens, updated, rule, now), rule)
+            # Once a bucket would have refilled, it is the same as no bucket
+            full_at = now + (rule.burst - tokens) / rule.rate
+            self.buckets[key] = (tokens, now, full_at)
+            self.takes += 1
+            if self.takes % self.prune_every == 0:
+                for stale in [name for name, bucket in self.buckets.items() if bucket[2] < now]:
+                    del self.buckets[stale]
+        return retry_after
+
+
+class SQLiteBackend:
+    """Buckets in a SQLite file shared by every worker on the machine.
+
+    Kept apart from the board's database so limiter writes never queue
+    behind (or in front of) posts.
+    """
+
+    def __init__(self, path, retention=3600):
+        self.path = path
+        self.retention = retention
+        self.local = threading.local()
+        with self._connect() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limits
+                (key TEXT PRIMARY KEY,
+                 tokens REAL NOT NULL,
+                 updated REAL NOT NULL)
+            ''')
+        self.last_pruned = time.time()
+
+    def _connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+        return db
+
+    def take(self, key, rule, now=None):
+        # Wall-clock time, since monotonic clocks differ between processes
+        now = time.time() if now is None else now
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute("SELECT tokens, updated FROM rate_limits WHERE key = ?",
+                             (key,)).fetchone()
+            tokens, updated = row if row else (rule.burst, now)
+            tokens, retry_after = _take(_refill(tokens, updated, rule, now), rule)
+            db.execute('''
+                INSERT INTO rate_limits (key, tokens, updated) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated
+            ''', (key, tokens, now))
+            if now - self.last_pruned > self.retention:
+                db.execute("DELETE FROM rate_limits WHERE updated < ?", (now - self.retention,))
+                self.last_pruned = now
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return retry_after
+
+
+def backend_from_url(url):
+    if not url or url == 'memory':
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    raise ValueError(f'Unknown rate limit backend {url!r}')
+
+
+def parse_rules(text):
+    """``'post_message=12/minute:5,add_reaction=5/second:20'`` -> {endpoint: Rule}."""
+    rules = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        endpoint, _, rule = item.partition('=')
+        rules[endpoint.strip()] = Rule.parse(rule)
+    return rules
+
+
+class RateLimiter:
+    def __init__(self, backend, rules):
+        self.backend = backend
+        self.rules = rules
+
+    def check(self, endpoint, client):
+        """Return None if the request may go ahead, else seconds until it may."""
+        rule = self.rules.get(endpoint)
+        if rule is None:
+            return None
+        retry_after = self.backend.take(f'{endpoint}:{client}', rule)
+        return retry_after or None
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
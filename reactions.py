@@ -0,0 +1,98 @@
+import json
+import threading
+import traceback
+from collections import Counter
+
+from changes import record_change
+from feed import MAX_IN_PARAMS
+
+
+class ReactionAccumulator:
+    """Write-behind buffer for reaction clicks.
+
+    ``add()`` only bumps an in-memory counter. A background thread flushes
+    the summed increments to the reactions table in one transaction every
+    ``interval`` seconds, logging one ``reaction_update`` change per message
+    in the same transaction, and calls ``on_flush({message_id: change})``
+    with each changed message's merged totals and seq. ``stop()`` flushes
+    whatever is still pending, and a failed flush puts its increments back
+    so they go out with the next one.
+    """
+
+    def __init__(self, db_pool, on_flush=None, interval=0.25):
+        self.db_pool = db_pool
+        self.on_flush = on_flush
+        self.interval = interval
+        self.lock = threading.Lock()
+        # Serializes flushes so a shutdown flush can't interleave with the timer's
+        self.flush_lock = threading.Lock()
+        self.pending = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, message_id, reaction, count=1):
+        with self.lock:
+            self.pending[(message_id, reaction)] += count
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='reaction-flush', daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, Counter()
+            if not batch:
+                return {}
+
+            try:
+                updated = self._write(batch)
+            except Exception:
+                with self.lock:
+                    self.pending.update(batch)
+                raise
+
+        if self.on_flush is not None:
+            self.on_flush(updated)
+        return updated
+
+    def _write(self, batch):
+        message_ids = sorted({message_id for message_id, _ in batch})
+        updated = {}
+        with self.db_pool.connection() as db, db:
+            cursor = db.cursor()
+            cursor.executemany('''
+                INSERT INTO reactions (message_id, reaction, count)
+                VALUES (?, ?, ?)
+                ON CONFLICT(message_id, reaction)
+                DO UPDATE SET count = count + excluded.count
+            ''', [(message_id, reaction, count)
+                  for (message_id, reaction), count in batch.items()])
+            for start in range(0, len(message_ids), MAX_IN_PARAMS):
+                chunk = message_ids[start:start + MAX_IN_PARAMS]
+                cursor.execute(f'''
+                    SELECT id, reaction_counts FROM messages
+                    WHERE id IN ({','.join('?' * len(chunk))})
+                ''', chunk)
+                for message_id, reaction_counts in cursor.fetchall():
+                    updated[message_id] = record_change(cursor, 'reaction_update', {
+                        'message_id': message_id,
+                        'reactions': json.loads(reaction_counts),
+                    }, message_id=message_id)
+        return updated
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
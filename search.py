@@ -0,0 +1,135 @@
+from markupsafe import Markup, escape
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_OFFSET = 1000
+
+# Stored text has these control characters stripped (see clean_text), so in
+# a snippet they can only be highlights until it has been HTML-escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+STRIP_MARKERS = str.maketrans('', '', HIGHLIGHT_START + HIGHLIGHT_END)
+
+
+def clean_text(text):
+    """Remove the highlight markers from text about to be stored."""
+    return text.translate(STRIP_MARKERS)
+
+
+def create_search_index(cursor):
+    for table in ('messages', 'comments'):
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                content,
+                content='{table}',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2')
+        ''')
+        # External-content tables must be told about every change
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO {table}_fts (rowid, content) VALUES (NEW.id, NEW.content);
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, content)
+                VALUES ('delete', OLD.id, OLD.content);
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF content ON {table}
+            BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, content)
+                VALUES ('delete', OLD.id, OLD.content);
+                INSERT INTO {table}_fts (rowid, content) VALUES (NEW.id, NEW.content);
+            END
+        ''')
+        cursor.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+def strip_highlight_markers(cursor):
+    # Rows stored before clean_text was applied on every write
+    for table in ('messages', 'comments'):
+        cursor.execute(f'''
+            UPDATE {table}
+            SET content = replace(replace(content, char(2), ''), char(3), '')
+            WHERE instr(content, char(2)) OR instr(content, char(3))
+        ''')
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query that matches all of its words.
+
+    Each word is quoted, so operators and punctuation typed by users are
+    searched for literally instead of being parsed as FTS syntax.
+    """
+    terms = [term.replace('"', '""') for term in query.split()]
+    return ' '.join(f'"{term}"' for term in terms if term.strip('"'))
+
+
+def highlight(snippet):
+    return Markup(str(escape(snippet))
+                  .replace(HIGHLIGHT_START, '<mark>')
+                  .replace(HIGHLIGHT_END, '</mark>'))
+
+
+def search(cursor, query, offset=0, limit=SEARCH_PAGE_SIZE):
+    """Rank messages and comments matching ``query`` by bm25.
+
+    Returns ``(hits, next_offset)``; each hit is a dict with the message it
+    belongs to, the comment id for comment hits, and a highlighted snippet.
+    """
+    expression = match_expression(query)
+    if not expression or offset > MAX_SEARCH_OFFSET:
+        return [], None
+
+    # Rank and page on the index alone; snippets and joins are only worth
+    # doing for the rows that make the page
+    cursor.execute('''
+        SELECT kind, rowid FROM (
+            SELECT 'message' AS kind, rowid, bm25(messages_fts) AS score
+            FROM messages_fts
+            WHERE messages_fts MATCH :query
+            UNION ALL
+            SELECT 'comment', rowid, bm25(comments_fts)
+            FROM comments_fts
+            WHERE comments_fts MATCH :query
+        )
+        ORDER BY score, kind DESC, rowid DESC
+        LIMIT :limit OFFSET :offset
+    ''', {'query': expression, 'limit': limit + 1, 'offset': offset})
+    rows = cursor.fetchall()
+
+    page = rows[:limit]
+    details = {}
+    snippet_args = f"'{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', 16"
+    for kind, table, message_id in (('message', 'messages', 'messages.id'),
+                                    ('comment', 'comments', 'comments.message_id')):
+        ids = [rowid for row_kind, rowid in page if row_kind == kind]
+        if not ids:
+            continue
+        cursor.execute(f'''
+            SELECT {table}.id, {message_id}, snippet({table}_fts, 0, {snippet_args}),
+                   {table}.timestamp
+            FROM {table}_fts
+            JOIN {table} ON {table}.id = {table}_fts.rowid
+            WHERE {table}_fts MATCH ? AND {table}_fts.rowid IN ({','.join('?' * len(ids))})
+        ''', [expression, *ids])
+        details.update(((kind, row[0]), row[1:]) for row in cursor.fetchall())
+
+    hits = []
+    for kind, rowid in page:
+        if (kind, rowid) not in details:
+            continue
+        message_id, snippet, timestamp = details[kind, rowid]
+        hits.append({
+            'kind': kind,
+            'message_id': message_id,
+            'comment_id': rowid if kind == 'comment' else None,
+            'snippet': highlight(snippet),
+            'timestamp': timestamp,
+        })
+    next_offset = offset + limit if len(rows) > limit else None
+    return hits, next_offset
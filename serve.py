@@ -0,0 +1,134 @@
+"""Production entry point: several worker processes sharing a message queue.
+
+    python serve.py --workers 4 --port 5000 --async-mode threading --queue redis://localhost:6379/0
+
+Worker N listens on port + N. Socket.IO's polling transport needs every
+request of a session to reach the same worker, so put a proxy with sticky
+sessions in front (nginx ``ip_hash`` over the worker ports). Events emitted
+in one worker reach clients of the others through the queue; without
+``--queue`` a SQLite file next to the database is used, which is fine on one
+machine. Rate-limit buckets are shared the same way, in ``rate_limits.db``,
+unless ``RATE_LIMIT_BACKEND`` says otherwise; behind a proxy, set
+``TRUSTED_PROXIES=1`` so clients are told apart by ``X-Forwarded-For``.
+The async mode has to be chosen with ``--async-mode`` (or
+``SOCKETIO_ASYNC_MODE``); nothing is picked for you. ``threading`` runs
+Werkzeug's development server. ``eventlet`` and ``gevent`` are untested with
+this app: the image encoder's process pool and the background flush,
+compaction and queue-listener threads have not been tried under monkey
+patching, and SQLite calls, busy-timeout waits included, block the whole
+worker under them.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+from contextlib import closing
+
+
+def exit_worker(signum, frame):
+    # SIGTERM would otherwise kill the worker without running atexit hooks,
+    # losing the reactions still waiting to be flushed. Ctrl+C reaches the
+    # worker and then the supervisor terminates it too, so only the first
+    # signal counts: another one must not interrupt the hooks.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sys.exit(0)
+
+
+def run_worker(host, port, async_mode):
+    # Monkey patching has to happen before anything else imports socket or
+    # threading, so the app is only imported afterwards
+    if async_mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif async_mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    os.environ['SOCKETIO_ASYNC_MODE'] = async_mode
+
+    signal.signal(signal.SIGTERM, exit_worker)
+    signal.signal(signal.SIGINT, exit_worker)
+    from app import MESSAGE_QUEUE, app, socketio
+    from pubsub import start_listening
+    if MESSAGE_QUEUE:
+        start_listening(socketio.server)
+    socketio.run(app, host=host, port=port, debug=False, use_reloader=False,
+                 log_output=False, allow_unsafe_werkzeug=True)
+
+
+def prepare_database():
+    # Workers would otherwise race each other through the migrations
+    from db import connect, migrate
+    from images import migrate_inline_images, store_from_env
+    with closing(connect(os.getenv('MESSAGE_BOARD_DB', 'message_board.db'))) as db:
+        migrate(db)
+        migrate_inline_images(db, store_from_env())
+
+
+def default_sqlite_url(filename):
+    database = os.path.abspath(os.getenv('MESSAGE_BOARD_DB', 'message_board.db'))
+    return f'sqlite:///{os.path.join(os.path.dirname(database), filename)}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000, help='port of the first worker')
+    parser.add_argument('--queue', default=os.getenv('SOCKETIO_MESSAGE_QUEUE'),
+                        help='message queue URL (redis://, kafka://, zmq+tcp://, amqp://, sqlite:///)')
+    parser.add_argument('--async-mode', choices=('eventlet', 'gevent', 'threading'),
+                        default=os.getenv('SOCKETIO_ASYNC_MODE'))
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.async_mode is None:
+        parser.error('choose --async-mode: threading runs the development server; '
+                     'eventlet and gevent are untested with this app')
+
+    if args.worker:
+        run_worker(args.host, args.port, args.async_mode)
+        return
+
+    prepare_database()
+    env = dict(os.environ)
+    if args.workers > 1 or args.queue:
+        env['SOCKETIO_MESSAGE_QUEUE'] = args.queue or default_sqlite_url('message_queue.db')
+    if args.workers > 1 and not env.get('RATE_LIMIT_BACKEND'):
+        # Limits must be counted across workers, or N workers allow N times as much
+        env['RATE_LIMIT_BACKEND'] = default_sqlite_url('rate_limits.db')
+
+    workers = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker',
+                          '--host', args.host, '--port', str(args.port + number),
+                          '--async-mode', args.async_mode], env=env)
+        for number in range(args.workers)
+    ]
+    print(f'{args.workers} {args.async_mode} worker(s) on {args.host} ports '
+          f'{args.port}-{args.port + args.workers - 1}, '
+          f'queue {env.get("SOCKETIO_MESSAGE_QUEUE", "none")}', flush=True)
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # If one worker dies the rest are stopped too, so a supervisor restarts
+    # the whole set instead of leaving a port dead behind the proxy
+    exit_code = 0
+    while workers:
+        pid, status = os.wait()
+        exited = [worker for worker in workers if worker.pid == pid]
+        if not exited:
+            continue
+        exited[0].returncode = os.waitstatus_to_exitcode(status)
+        workers.remove(exited[0])
+        exit_code = exit_code or exited[0].returncode
+        stop(None, None)
+    sys.exit(max(exit_code, 0))
+
+
+if __name__ == '__main__':
+    main()
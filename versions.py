@@ -0,0 +1,75 @@
+"""Per-feed content versions for conditional requests.
+
+``feed_versions`` has one row per feed (``feed`` or ``tag:<name>``) whose
+version is bumped by triggers whenever a message, tag link, comment or
+reaction that can appear on that feed changes.
+"""
+from datetime import datetime, timezone
+
+BUMP_SQL = '''
+    INSERT INTO feed_versions (feed, version, updated_at)
+    {source}
+    ON CONFLICT(feed) DO UPDATE SET version = version + 1,
+                                    updated_at = excluded.updated_at;
+'''
+
+
+def _bump_feed():
+    return BUMP_SQL.format(source="VALUES ('feed', 1, CURRENT_TIMESTAMP)")
+
+
+def _bump_tag(tag_id):
+    return BUMP_SQL.format(source=f'''
+        SELECT 'tag:' || name, 1, CURRENT_TIMESTAMP FROM tags WHERE id = {tag_id} AND true''')
+
+
+def _bump_tags(message_id):
+    # WHERE true: an upsert fed by a SELECT needs a WHERE clause to parse
+    return BUMP_SQL.format(source=f'''
+        SELECT 'tag:' || tags.name, 1, CURRENT_TIMESTAMP
+        FROM message_tags JOIN tags ON tags.id = message_tags.tag_id
+        WHERE message_tags.message_id = {message_id} AND true''')
+
+
+def create_feed_versions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feed_versions
+        (feed TEXT PRIMARY KEY,
+         version INTEGER NOT NULL,
+         updated_at DATETIME NOT NULL)
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_feed_version
+        AFTER INSERT ON messages
+        BEGIN
+            {_bump_feed()}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS message_tags_feed_version
+        AFTER INSERT ON message_tags
+        BEGIN
+            {_bump_feed()}
+            {_bump_tag('NEW.tag_id')}
+        END
+    ''')
+    for table in ('comments', 'reactions'):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_feed_version_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    {_bump_feed()}
+                    {_bump_tags(f'{row}.message_id')}
+                END
+            ''')
+
+
+def feed_version(cursor, feed):
+    """Return ``(version, last_modified)`` for a feed; (0, None) if never written."""
+    cursor.execute("SELECT version, updated_at FROM feed_versions WHERE feed = ?", (feed,))
+    row = cursor.fetchone()
+    if row is None:
+        return 0, None
+    updated_at = datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return row[0], updated_at